@@ -1,116 +1,160 @@
-import os, requests, uuid
+import os, json, uuid, base64, hashlib, threading, requests
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from flask import Flask, request, jsonify, render_template_string
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from square_client import (
     ensure_config_ok, create_customer, create_card_on_file,
-    create_payment_with_card, create_payment_with_nonce, _cfg
+    create_payment_with_card, create_payment_with_nonce, list_payments, disable_card, create_quick_pay_link,
+    delete_payment_link, probe_location
 )
-from supabase import create_client, Client
+from postgrest.exceptions import APIError
+from settings import get_settings
+import supabase_client
+from supabase_client import get_supabase
+from idempotency import idempotent, current_key, square_key
+from cache import TTLCache, SingleFlight
+from shared_store import get_store, get_default_store
+from breaker import breakers, get_breaker, UpstreamUnavailable
+import metrics
+from metrics import observe_upstream
+import log
+import jobs
+import reconcile
+import card_sync
+from link_pool import get_link_pool
+from static_page import StaticPage
+from ratelimit import limiter
+import webhooks
+import outbox
+from probes import get_prober
+from json_provider import FastJSONProvider
+
+# Entorno validado una vez al importar: un valor inválido falla el arranque (SettingsError)
+_settings = get_settings()
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+if _settings.trusted_proxies:
+    # request.remote_addr = IP del cliente, no la del proxy (rate limit por IP)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_settings.trusted_proxies, x_proto=_settings.trusted_proxies)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+metrics.init_app(app)
 
-API_KEY = os.getenv("INTERNAL_API_KEY")  # opcional
+# ====================== SUPABASE ======================
+# Cliente perezoso por worker (supabase_client.get_supabase): importar este
+# módulo no crea clientes ni abre conexiones (gunicorn puede hacer preload).
 
-# ====================== SUPABASE SETUP ======================
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE") or os.getenv("SUPABASE_KEY")
+def require_key():
+    api_key = get_settings().internal_api_key
+    if api_key and request.headers.get("X-Api-Key") != api_key:
+        return jsonify({"error":"unauthorized"}), 401
 
-supabase: Client = None
+def _sb(query):
+    """Ejecutar una query de Supabase a través del circuit breaker"""
+    try:
+        return get_breaker("supabase").call(
+            observe_upstream, "supabase", f"{query.http_method} {query.path}", query.execute,
+            ignore=supabase_client.is_client_error,
+        )
+    except supabase_client.CONNECTION_ERRORS:
+        supabase_client.reset()  # el próximo get_supabase() arma un cliente nuevo
+        raise
 
-# 🔍 DEBUG: Mostrar exactamente qué variables tenemos
-print(f"🔍 DEBUG SUPABASE:")
-print(f"   SUPABASE_URL: {SUPABASE_URL}")
-print(f"   SUPABASE_SERVICE_KEY length: {len(SUPABASE_SERVICE_KEY) if SUPABASE_SERVICE_KEY else 'None'}")
-print(f"   SUPABASE_SERVICE_KEY starts with: {SUPABASE_SERVICE_KEY[:20] if SUPABASE_SERVICE_KEY else 'None'}...")
+def _unavailable(e):
+    return jsonify({
+        "status": "FAILED", "code": e.code, "upstream": e.upstream, "message": str(e)
+    }), e.status_code, {"Retry-After": str(round(e.retry_after))}
 
-try:
-    if SUPABASE_URL and SUPABASE_SERVICE_KEY:
-        print(f"🔄 Intentando conectar a Supabase...")
-        supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-        print(f"✅ Supabase conectado exitosamente!")
-    else:
-        print("⚠️ Variables faltantes:")
-        print(f"   SUPABASE_URL: {'✅' if SUPABASE_URL else '❌'}")
-        print(f"   SUPABASE_SERVICE_KEY: {'✅' if SUPABASE_SERVICE_KEY else '❌'}")
-except Exception as e:
-    print(f"❌ Error conectando Supabase: {e}")
-    print(f"❌ Tipo de error: {type(e)}")
-    print("⚠️ Continuando sin Supabase - algunos endpoints no funcionarán")
-    supabase = None
-
-def require_key():
-    if API_KEY and request.headers.get("X-Api-Key") != API_KEY:
-        return jsonify({"error":"unauthorized"}), 401
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(e):
+    return _unavailable(e)
 
 @app.get("/health")
 def health():
     ok, meta = ensure_config_ok()
-    supabase_ready = supabase is not None
-    return {"ok": True, "square_ready": ok, "supabase_ready": supabase_ready, **meta}
+    supabase_ready = get_supabase() is not None
+    return {
+        "ok": True, "square_ready": ok, "supabase_ready": supabase_ready, **meta,
+        "upstreams": {name: b.snapshot() for name, b in breakers.items()},
+        "caches": {
+            "customers": {**_customer_cache.stats(), "shared": get_store() is not None},
+            "cards": _cards_cache.stats(),
+            "card_owners": _card_owners.stats(),
+        },
+        "card_sync": card_sync.get_card_sync().snapshot(),
+        "payment_link_pool": _link_pool.stats(),
+        "rate_limits": limiter.stats(),
+        "webhooks": webhooks.get_webhooks().stats(),
+        "outbox": outbox.get_outbox().snapshot(),
+        "probes": get_prober().snapshot(),
+    }
+
+@app.get("/health/deep")
+def health_deep():
+    """Último resultado de los probes de fondo (sin llamar a Square/Supabase); 503 si alguno está down"""
+    probes = get_prober().snapshot()
+    body = {**probes, "breakers": {name: b.snapshot() for name, b in breakers.items()}}
+    return body, 503 if probes["status"] == "down" else 200
+
+def _probe_supabase():
+    client = get_supabase()
+    if client is None:
+        raise RuntimeError("Supabase no disponible (cliente sin crear)")
+    try:
+        client.table("user_square").select("user_id").limit(1).execute()
+    except supabase_client.CONNECTION_ERRORS:
+        supabase_client.reset()
+        raise
+
+_PROBE_TIMEOUT = _settings.health_probe_timeout
+
+get_prober().register("square", lambda: probe_location(timeout=_PROBE_TIMEOUT),
+                      enabled=lambda: get_settings().square_ready)
+get_prober().register("supabase", _probe_supabase, enabled=lambda: get_settings().supabase_configured)
 
 @app.get("/__ping")
 def ping():
     return {"ok": True, "service": "payments"}, 200
 
+# Links quick pay pre-creados para montos fijos (PAYMENT_LINK_POOL_AMOUNTS)
+_link_pool = get_link_pool(lambda amount, currency, note: create_quick_pay_link(amount, currency, note),
+                           delete=delete_payment_link)
+
 @app.post("/api/payment-links/create")
+@idempotent
+@limiter.limit
 def create_payment_link():
-    """Crear Payment Link de Square - SIMPLE Y DIRECTO"""
+    """Crear Payment Link de Square: del pool si hay uno para el monto, si no en línea"""
     try:
         data = request.get_json() or {}
         amount_cents = int(data.get("amount", 100))
         currency = data.get("currency", "USD")
         note = data.get("note", "Recarga Cubalink23")
         
-        # Crear Payment Link usando Square REST API
-        env, base, token, location_id = _cfg()
-        
-        body = {
-            "idempotency_key": str(uuid.uuid4()),
-            "quick_pay": {
-                "location_id": location_id,
-                "name": f"Recarga ${amount_cents/100:.2f}",
-                "price_money": {
-                    "amount": amount_cents,
-                    "currency": currency
-                }
-            },
-            "description": note,
-            "checkout_options": {
-                "redirect_url": "cubalink23://payment-success",
-                "ask_for_shipping_address": False
-            }
-        }
+        payment_link = _link_pool.take(amount_cents, currency, note)
+        if payment_link is None:
+            payment_link = create_quick_pay_link(amount_cents, currency, note, idempotency_key=current_key() or square_key())
         
-        response = requests.post(
-            f"{base}/v2/online-checkout/payment-links",
-            headers={
-                "Square-Version": "2024-08-21",
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            },
-            json=body,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            payment_link = response.json()["payment_link"]
-            return jsonify({
-                "success": True,
-                "payment_link_id": payment_link["id"],
-                "payment_url": payment_link["url"],
-                "amount": amount_cents,
-                "currency": currency
-            }), 200
-        else:
-            error = response.json() if response.content else {"message": "Error creating payment link"}
+        if "error" in payment_link:
+            headers = {"Retry-After": str(payment_link["retry_after"])} if "retry_after" in payment_link else {}
             return jsonify({
                 "success": False,
-                "error": error
-            }), response.status_code
+                "error": payment_link["error"]
+            }), payment_link["status_code"], headers
+        
+        return jsonify({
+            "success": True,
+            "payment_link_id": payment_link["id"],
+            "payment_url": payment_link["url"],
+            "order_id": payment_link.get("order_id"),
+            "amount": amount_cents,
+            "currency": currency
+        }), 200
             
     except Exception as e:
-        print(f"❌ Error creando payment link: {e}")
+        log.error("payment_link_failed", exc=e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -119,12 +163,12 @@ def create_payment_link():
 @app.get("/debug/users")
 def debug_users():
     """TEMPORAL: Buscar usuarios en Supabase"""
-    if not supabase:
+    if get_supabase() is None:
         return {"error": "Supabase no configurado"}, 500
     
     try:
         # Buscar usuarios que contengan "lander" en el email o nombre
-        result = supabase.table("users").select("id, email, raw_user_meta_data").limit(10).execute()
+        result = _sb(get_supabase().table("users").select("id, email, raw_user_meta_data").limit(10))
         
         users = []
         for user in result.data:
@@ -141,10 +185,65 @@ def debug_users():
 
 # ====================== ENDPOINTS CARD-ON-FILE SEGÚN AMIGO ======================
 
+# user_id -> square_customer_id (el vínculo no cambia una vez escrito)
+_customer_cache = TTLCache(
+    maxsize=_settings.customer_cache_size,
+    ttl=_settings.customer_cache_ttl,
+)
+_customer_flight = SingleFlight()
+
+def _cached_customer_id(user_id):
+    square_customer_id = _customer_cache.get(user_id)
+    if square_customer_id is None and (store := get_store()):
+        square_customer_id = store.get(f"customer:{user_id}")
+        if square_customer_id:
+            _customer_cache.set(user_id, square_customer_id)
+    return square_customer_id
+
+def _remember_customer(user_id, square_customer_id):
+    _customer_cache.set(user_id, square_customer_id)
+    if store := get_store():
+        store.set(f"customer:{user_id}", square_customer_id, ttl=_customer_cache.ttl)
+
+def _lookup_or_create_customer(user_id, email, name):
+    # Otro request pudo llenarlo mientras esperábamos turno
+    square_customer_id = _cached_customer_id(user_id)
+    if square_customer_id:
+        return square_customer_id
+
+    # Creado hace instantes y todavía en el outbox local
+    if "user_square" in _OUTBOX and (pending := outbox.get_outbox().pending("user_square", user_id)):
+        _remember_customer(user_id, pending["square_customer_id"])
+        return pending["square_customer_id"]
+
+    # Verificar si ya existe en Supabase
+    result = _sb(get_supabase().table("user_square").select("square_customer_id").eq("user_id", user_id))
+    
+    if result.data:
+        # Ya existe
+        square_customer_id = result.data[0]["square_customer_id"]
+        log.info("square_customer_found", user_id=user_id, square_customer_id=square_customer_id)
+    else:
+        # Crear nuevo customer en Square (key derivado del user_id: workers
+        # concurrentes reciben el mismo customer de Square)
+        customer = create_customer(
+            given_name=name, email=email, reference_id=user_id,
+            idempotency_key=str(uuid.uuid5(uuid.NAMESPACE_URL, f"square-customer:{user_id}")),
+        )
+        square_customer_id = customer["id"]
+        
+        # Guardar en Supabase (vía outbox: no espera el round trip)
+        _save_customer_row({"user_id": user_id, "square_customer_id": square_customer_id})
+        
+        log.info("square_customer_created", user_id=user_id, square_customer_id=square_customer_id)
+
+    _remember_customer(user_id, square_customer_id)
+    return square_customer_id
+
 @app.post("/api/square/customers/ensure")
 def ensure_square_customer():
     """1) Crear/obtener Customer en Square y vincular en Supabase"""
-    if not supabase:
+    if get_supabase() is None:
         return jsonify({"error": "Supabase no configurado"}), 500
         
     data = request.get_json() or {}
@@ -156,36 +255,74 @@ def ensure_square_customer():
         return jsonify({"error": "user_id requerido"}), 400
     
     try:
-        # Verificar si ya existe en Supabase
-        result = supabase.table("user_square").select("square_customer_id").eq("user_id", user_id).execute()
-        
-        if result.data:
-            # Ya existe
-            square_customer_id = result.data[0]["square_customer_id"]
-            print(f"✅ Customer existente: {square_customer_id}")
-        else:
-            # Crear nuevo customer en Square
-            customer = create_customer(given_name=name, email=email, reference_id=user_id)
-            square_customer_id = customer["id"]
-            
-            # Guardar en Supabase
-            supabase.table("user_square").insert({
-                "user_id": user_id,
-                "square_customer_id": square_customer_id
-            }).execute()
-            
-            print(f"🆕 Nuevo customer creado: {square_customer_id}")
+        square_customer_id = _cached_customer_id(user_id)
+        if not square_customer_id:
+            # Primeras llamadas concurrentes del mismo usuario → un solo create_customer
+            square_customer_id = _customer_flight.do(
+                user_id, lambda: _lookup_or_create_customer(user_id, email, name)
+            )
         
         return jsonify({"square_customer_id": square_customer_id}), 200
         
+    except UpstreamUnavailable as e:
+        return _unavailable(e)
     except Exception as e:
-        print(f"❌ Error ensure customer: {e}")
+        log.error("ensure_customer_failed", exc=e, user_id=user_id)
         return jsonify({"error": str(e)}), 500
 
+# ====================== OUTBOX ======================
+# Escrituras de ensure_customer / cards/create: se registran en el outbox local
+# (outbox.py) y un hilo las lleva a Supabase en lote. SUPABASE_OUTBOX = tablas que
+# pasan por el outbox. Por defecto solo user_square: la respuesta de cards/create
+# incluye id e is_default, que decide Supabase (con payment_cards van en null).
+_OUTBOX = _settings.supabase_outbox
+
+def _save_customer_row(row):
+    if "user_square" in _OUTBOX:
+        outbox.get_outbox().enqueue("user_square", row["user_id"], row, ref=row["user_id"])
+    else:
+        _sb(get_supabase().table("user_square").insert(row))
+
+def _write_customer_rows(rows):
+    # Un reintento del mismo usuario no duplica (sql/outbox.sql)
+    rows = list({r["user_id"]: r for r in rows}.values())
+    _sb(get_supabase().table("user_square").upsert(rows, on_conflict="user_id", ignore_duplicates=True))
+
+def _write_card_rows(rows):
+    try:
+        _sb(get_supabase().rpc("save_payment_cards", {"p_cards": rows}))
+    except APIError as e:
+        if e.code != "PGRST202":
+            raise
+        for row in rows:  # sql/outbox.sql sin desplegar: una llamada por tarjeta
+            _save_card_row(row)
+    # El listado cacheado no incluía la tarjeta pendiente (la generación llega a todos los workers)
+    for user_id in {r["user_id"] for r in rows}:
+        _invalidate_user_cards(user_id)
+
+outbox.register("user_square", _write_customer_rows)
+outbox.register("payment_cards", _write_card_rows)
+
+def _save_card_row(card_data):
+    """Insertar metadata + decidir is_default atómicamente (rpc save_payment_card, sql/save_payment_card.sql)"""
+    try:
+        result = _sb(get_supabase().rpc("save_payment_card", {f"p_{k}": v for k, v in card_data.items()}))
+        return result.data[0] if result.data else dict(card_data)
+    except APIError as e:
+        if e.code != "PGRST202":
+            raise
+    # Función aún no desplegada: camino anterior (2 round trips, sin protección de carrera)
+    log.warning("save_payment_card_rpc_missing")
+    existing_cards = _active_cards(lambda: get_supabase().table("payment_cards").select("id")
+                                   .eq("user_id", card_data["user_id"]).limit(1))
+    row = {**card_data, "is_default": len(existing_cards.data) == 0}
+    result = _sb(get_supabase().table("payment_cards").insert(row))
+    return result.data[0] if result.data else row
+
 @app.post("/api/cards/create")
 def create_card_with_metadata():
     """2) Guardar tarjeta (Card-on-File) con metadata en Supabase"""
-    if not supabase:
+    if get_supabase() is None:
         return jsonify({"error": "Supabase no configurado"}), 500
         
     data = request.get_json() or {}
@@ -200,16 +337,12 @@ def create_card_with_metadata():
     
     try:
         # Crear tarjeta EN Square
-        card = create_card_on_file(customer_id, nonce)
+        card = create_card_on_file(customer_id, nonce, reference_id=card_sync.TRACKED_REFERENCE)
         
         if "error" in card:
             return jsonify({"error": card["error"]}), 400
         
-        # Verificar si es la primera tarjeta del usuario
-        existing_cards = supabase.table("payment_cards").select("id").eq("user_id", user_id).execute()
-        is_default = len(existing_cards.data) == 0
-        
-        # Guardar metadata en Supabase
+        # Guardar metadata en Supabase (is_default se decide en el mismo round trip)
         card_data = {
             "user_id": user_id,
             "square_card_id": card["id"],  # ccof:...
@@ -220,10 +353,17 @@ def create_card_with_metadata():
             "exp_year": card.get("exp_year"),
             "zip_code": postal_code,
             "holder_name": name,
-            "is_default": is_default
         }
         
-        result = supabase.table("payment_cards").insert(card_data).execute()
+        if "payment_cards" in _OUTBOX:
+            # id e is_default los decide Supabase al drenar el outbox
+            outbox.get_outbox().enqueue("payment_cards", user_id, card_data, ref=card["id"])
+            row = {"id": None, "is_default": None}
+        else:
+            row = _save_card_row(card_data)
+        # En todos los workers (generación en get_default_store); el drenado vuelve a invalidar
+        _invalidate_user_cards(user_id)
+        _remember_card_owner(card["id"], user_id, postal_code)
         
         return jsonify({
             "square_card_id": card["id"],
@@ -231,53 +371,211 @@ def create_card_with_metadata():
             "last4": card.get("last_4"),
             "exp_month": card.get("exp_month"),
             "exp_year": card.get("exp_year"),
-            "is_default": is_default,
-            "supabase_id": result.data[0]["id"] if result.data else None
+            "is_default": row.get("is_default"),
+            "supabase_id": row.get("id"),
+            "pending": row.get("id") is None,
         }), 200
         
+    except UpstreamUnavailable as e:
+        return _unavailable(e)
     except Exception as e:
-        print(f"❌ Error crear tarjeta: {e}")
+        log.error("create_card_failed", exc=e, user_id=user_id)
         return jsonify({"error": str(e)}), 500
 
+_MISSING = object()
+
+# user_id -> (generación, {(fields, limit, cursor): (JSON ya serializado, etag)}) de GET /api/cards
+_cards_cache = TTLCache(
+    maxsize=_settings.cards_cache_size,
+    ttl=_settings.cards_cache_ttl,
+)
+
+def _cards_generation(user_id):
+    # Store SQLite siempre presente: una invalidación en otro worker cambia la generación
+    return get_default_store().get(f"cards_gen:{user_id}")
+
+def _invalidate_user_cards(user_id):
+    _cards_cache.pop(user_id)
+    # La generación vive lo que la entrada más larga que la usa (índice de pertenencia):
+    # si venciera antes, una entrada vieja con generación None volvería a ser válida
+    get_default_store().set(f"cards_gen:{user_id}", uuid.uuid4().hex, ttl=max(_cards_cache.ttl, _card_owners.ttl))
+
+# square_card_id -> (user_id, generación de tarjetas del usuario, zip_code)
+# Índice de pertenencia para el checkout 1 toque; una invalidación de tarjetas
+# del usuario (crear/eliminar, en cualquier worker) cambia la generación.
+# También guarda el ZIP de facturación (payment_cards.zip_code) que va a Square.
+_card_owners = TTLCache(
+    maxsize=_settings.card_index_size,
+    ttl=_settings.card_index_ttl,
+)
+
+def _remember_card_owner(square_card_id, user_id, zip_code=None, generation=_MISSING):
+    if generation is _MISSING:
+        generation = _cards_generation(user_id)
+    _card_owners.set(square_card_id, (user_id, generation, zip_code))
+
+_card_status_missing = False
+
+def _active_cards(build):
+    """Ejecutar build() filtrando status=active; sin sql/payment_cards_status.sql (42703) sin filtro.
+    La falta de la columna se recuerda por proceso (aplicar el SQL y reiniciar)"""
+    global _card_status_missing
+    if not _card_status_missing:
+        try:
+            return _sb(build().eq("status", card_sync.ACTIVE))
+        except APIError as e:
+            if e.code != "42703":
+                raise
+        # Columna aún no desplegada: todas las tarjetas cuentan como activas
+        log.warning("payment_cards_status_missing")
+        _card_status_missing = True
+    return _sb(build())
+
+def _card_belongs_to(square_card_id, user_id):
+    """Pertenencia en memoria; si no está en el índice, consultar Supabase"""
+    owner = _card_owners.get(square_card_id)
+    if owner is not None and owner[0] == user_id and owner[1] == _cards_generation(user_id):
+        return True
+    card_check = _active_cards(lambda: get_supabase().table("payment_cards").select("zip_code")
+                               .eq("square_card_id", square_card_id).eq("user_id", user_id))
+    if not card_check.data:
+        return False
+    _remember_card_owner(square_card_id, user_id, card_check.data[0].get("zip_code"))
+    return True
+
+def _card_zip(square_card_id, fetch=True):
+    """ZIP de facturación de la tarjeta: índice local; si fetch, Supabase en un miss"""
+    entry = _card_owners.get(square_card_id)
+    if entry is not None:
+        return entry[2]
+    if not fetch or get_supabase() is None:
+        return None
+    try:
+        result = _sb(get_supabase().table("payment_cards").select("user_id, zip_code").eq("square_card_id", square_card_id).limit(1))
+    except Exception as e:
+        # Sin ZIP el cobro sigue con el default; no bloquear por esto
+        log.warning("card_zip_lookup_failed", exc=e, square_card_id=square_card_id)
+        return None
+    if not result.data:
+        return None
+    row = result.data[0]
+    _remember_card_owner(square_card_id, row["user_id"], row.get("zip_code"))
+    return row.get("zip_code")
+
+# Campo de la respuesta -> columna de payment_cards (orden = orden en la respuesta)
+CARD_FIELDS = {
+    "id": "id", "square_card_id": "square_card_id", "brand": "card_type", "last4": "last4",
+    "exp_month": "exp_month", "exp_year": "exp_year", "is_default": "is_default",
+    "holder_name": "holder_name", "created_at": "created_at",
+}
+CARDS_PAGE_MAX = _settings.cards_page_max
+CARDS_PAGE_SIZE = _settings.cards_page_size
+_CARDS_VARIANTS = 16   # combinaciones fields/limit/cursor cacheadas por usuario
+
+def _encode_cursor(card):
+    raw = json.dumps([card["created_at"], card["id"]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    """(created_at, id) de la última tarjeta de la página anterior; ValueError si no es válido"""
+    try:
+        created_at, card_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("cursor inválido") from None
+    # Los valores van dentro de un filtro or=(...) de PostgREST
+    if not isinstance(created_at, str) or not isinstance(card_id, (int, str)) or any(c in f"{created_at}{card_id}" for c in ",()"):
+        raise ValueError("cursor inválido")
+    return created_at, card_id
+
+def _cards_page_args(args):
+    """(fields, limit, cursor) de la query string; ValueError → 400"""
+    fields = tuple(CARD_FIELDS)
+    if raw := args.get("fields"):
+        fields = tuple(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+        unknown = [f for f in fields if f not in CARD_FIELDS]
+        if unknown or not fields:
+            raise ValueError(f"fields desconocidos: {', '.join(unknown)} (válidos: {', '.join(CARD_FIELDS)})")
+    try:
+        limit = int(args.get("limit", CARDS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit debe ser un entero") from None
+    if not 1 <= limit <= CARDS_PAGE_MAX:
+        raise ValueError(f"limit debe estar entre 1 y {CARDS_PAGE_MAX}")
+    cursor = args.get("cursor") or None
+    if cursor:
+        _decode_cursor(cursor)
+    return fields, limit, cursor
+
+def _load_user_cards(user_id, generation=None, fields=tuple(CARD_FIELDS), limit=CARDS_PAGE_SIZE, cursor=None):
+    """Una página (keyset sobre created_at DESC, id DESC): solo las columnas pedidas + las del cursor"""
+    columns = dict.fromkeys([CARD_FIELDS[f] for f in fields] + ["created_at", "id"])
+    # square_card_id + zip_code alimentan el índice de pertenencia (el zip no sale en la respuesta)
+    index = "square_card_id" in columns
+    if index:
+        columns["zip_code"] = None
+    def build():
+        query = (get_supabase().table("payment_cards").select(", ".join(columns))
+                 .eq("user_id", user_id)
+                 .order("created_at.desc,id", desc=True)   # order=created_at.desc,id.desc (un solo parámetro)
+                 .limit(limit + 1))
+        if cursor:
+            created_at, card_id = _decode_cursor(cursor)
+            query.params = query.params.add("or", f"(created_at.lt.{created_at},and(created_at.eq.{created_at},id.lt.{card_id}))")
+        return query
+    rows = _active_cards(build).data
+    
+    page, more = rows[:limit], len(rows) > limit
+    cards = []
+    for card in page:
+        if index:
+            _remember_card_owner(card["square_card_id"], user_id, card.get("zip_code"), generation)
+        cards.append({f: card[CARD_FIELDS[f]] for f in fields})
+    
+    body = app.json.dumps({"cards": cards, "next_cursor": _encode_cursor(page[-1]) if more else None}).encode()
+    return body, hashlib.sha1(body).hexdigest()
+
 @app.get("/api/cards")
 def list_user_cards():
-    """3) Listar tarjetas para el perfil"""
-    if not supabase:
+    """3) Listar tarjetas para el perfil (cacheado por usuario, ETag / 304).
+    ?limit=&cursor= paginan (next_cursor en la respuesta); ?fields=last4,is_default proyecta"""
+    if get_supabase() is None:
         return jsonify({"error": "Supabase no configurado"}), 500
         
     user_id = request.args.get("user_id")
     if not user_id:
         return jsonify({"error": "user_id requerido"}), 400
+    try:
+        variant = _cards_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     try:
-        result = supabase.table("payment_cards").select(
-            "id, square_card_id, card_type, last4, exp_month, exp_year, is_default, holder_name, created_at"
-        ).eq("user_id", user_id).order("created_at", desc=True).execute()
-        
-        cards = []
-        for card in result.data:
-            cards.append({
-                "id": card["id"],
-                "square_card_id": card["square_card_id"],
-                "brand": card["card_type"],
-                "last4": card["last4"],
-                "exp_month": card["exp_month"],
-                "exp_year": card["exp_year"],
-                "is_default": card["is_default"],
-                "holder_name": card["holder_name"],
-                "created_at": card["created_at"]
-            })
+        generation = _cards_generation(user_id)
+        cached = _cards_cache.get(user_id)
+        variants = cached[1] if cached is not None and cached[0] == generation else {}
+        if variant in variants:
+            body, etag = variants[variant]
+        else:
+            body, etag = _load_user_cards(user_id, generation, *variant)
+            if len(variants) >= _CARDS_VARIANTS:
+                variants = {}
+            _cards_cache.set(user_id, (generation, {**variants, variant: (body, etag)}))
         
-        return jsonify({"cards": cards}), 200
+        response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
         
+    except UpstreamUnavailable as e:
+        return _unavailable(e)
     except Exception as e:
-        print(f"❌ Error listar tarjetas: {e}")
+        log.error("list_cards_failed", exc=e, user_id=user_id)
         return jsonify({"error": str(e)}), 500
 
 @app.delete("/api/cards/<square_card_id>")
 def delete_user_card(square_card_id):
     """4) Eliminar tarjeta"""
-    if not supabase:
+    if get_supabase() is None:
         return jsonify({"error": "Supabase no configurado"}), 500
         
     user_id = request.args.get("user_id")
@@ -285,25 +583,36 @@ def delete_user_card(square_card_id):
         return jsonify({"error": "user_id requerido"}), 400
     
     try:
-        # TODO: Llamar a Square API para deshabilitar tarjeta
-        # requests.post(f"{base_url}/v2/cards/{square_card_id}/disable", headers=headers)
+        # Todavía en el outbox: que no llegue a Supabase
+        cancelled = 0
+        if "payment_cards" in _OUTBOX and (pending := outbox.get_outbox().pending("payment_cards", square_card_id)):
+            if pending["user_id"] == user_id:
+                cancelled = outbox.get_outbox().cancel("payment_cards", square_card_id)
         
-        # Eliminar de Supabase
-        result = supabase.table("payment_cards").delete().eq("square_card_id", square_card_id).eq("user_id", user_id).execute()
+        # Eliminar de Supabase (el filtro por user_id valida la pertenencia)
+        result = _sb(get_supabase().table("payment_cards").delete().eq("square_card_id", square_card_id).eq("user_id", user_id))
+        _invalidate_user_cards(user_id)
+        _card_owners.pop(square_card_id)
         
-        if not result.data:
+        if not result.data and not cancelled:
             return jsonify({"error": "Tarjeta no encontrada"}), 404
         
+        # Deshabilitar en Square; si falla queda como huérfana para card_sync
+        try:
+            disable_card(square_card_id)
+        except Exception as e:
+            log.warning("square_disable_card_failed", exc=e, square_card_id=square_card_id)
+        
         return jsonify({"message": "Tarjeta eliminada exitosamente"}), 200
         
+    except UpstreamUnavailable as e:
+        return _unavailable(e)
     except Exception as e:
-        print(f"❌ Error eliminar tarjeta: {e}")
+        log.error("delete_card_failed", exc=e, user_id=user_id, square_card_id=square_card_id)
         return jsonify({"error": str(e)}), 500
 
-@app.post("/api/payments/charge")
-def charge_saved_card():
-    """5) Pagar con card-on-file (checkout 1 toque)"""
-    data = request.get_json() or {}
+def _charge_saved_card(data, idempotency_key=None):
+    """Cobro card-on-file → (body, http_status). Compartido por /charge y /batch"""
     user_id = data.get("user_id")
     amount = data.get("amount")  # centavos
     currency = data.get("currency", "USD")
@@ -312,53 +621,171 @@ def charge_saved_card():
     note = data.get("note", "Recarga Cubalink23")
     
     if not all([user_id, amount, square_card_id, customer_id]):
-        return jsonify({"error": "user_id, amount, square_card_id y customer_id requeridos"}), 400
+        return {"error": "user_id, amount, square_card_id y customer_id requeridos"}, 400
     
     try:
         # Validar que la tarjeta pertenece al usuario
-        if supabase:
-            card_check = supabase.table("payment_cards").select("id").eq("square_card_id", square_card_id).eq("user_id", user_id).execute()
-            if not card_check.data:
-                return jsonify({"error": "Tarjeta no encontrada o no autorizada"}), 403
+        if get_supabase() is not None:
+            if not _card_belongs_to(square_card_id, user_id):
+                return {"error": "Tarjeta no encontrada o no autorizada"}, 403
         
         # Procesar pago con Square
-        payment = create_payment_with_card(customer_id, square_card_id, int(amount), currency, note)
+        payment = create_payment_with_card(customer_id, square_card_id, int(amount), currency, note,
+                                           idempotency_key=idempotency_key, postal_code=_card_zip(square_card_id, fetch=False))
         
         if "error" in payment:
-            return jsonify({
+            return {
                 "status": "FAILED",
                 "error": payment["error"],
                 "status_code": payment.get("status_code", 400)
-            }), payment.get("status_code", 400)
+            }, payment.get("status_code", 400)
         
         status = payment.get("status")
         success = status == "COMPLETED"
         
-        return jsonify({
+        return {
             "status": status,
             "payment_id": payment.get("id"),
             "receipt_url": payment.get("receipt_url"),
             "success": success,
             "amount": amount,
             "currency": currency
-        }), (200 if success else 400)
+        }, (200 if success else 400)
         
+    except UpstreamUnavailable as e:
+        return {"status": "FAILED", "code": e.code, "upstream": e.upstream, "error": str(e)}, e.status_code
     except Exception as e:
-        print(f"❌ Error pago card-on-file: {e}")
-        return jsonify({
+        log.error("charge_saved_card_failed", exc=e, user_id=user_id, square_card_id=square_card_id)
+        return {
             "status": "FAILED",
             "error": str(e)
-        }), 500
+        }, 500
+
+@app.post("/api/payments/charge")
+@idempotent
+@limiter.limit
+def charge_saved_card():
+    """5) Pagar con card-on-file (checkout 1 toque)"""
+    data = request.get_json() or {}
+    body, status = _charge_saved_card(data, idempotency_key=current_key())
+    return jsonify(body), status
+
+# ====================== BATCH (Recargas programadas) ======================
+BATCH_MAX_ITEMS = _settings.batch_max_items
+# Más cargos que esto van por la cola de jobs (202): a ~1 s por cobro y concurrencia 8,
+# 100 cargos caben holgados en el timeout de un worker sync (GUNICORN_TIMEOUT=60)
+BATCH_SYNC_MAX_ITEMS = _settings.batch_sync_max_items
+BATCH_MAX_CONCURRENCY = _settings.batch_max_concurrency
+
+_batch_pool = None
+_batch_pool_pid = None
+_batch_pool_lock = threading.Lock()
+
+def _get_batch_pool():
+    # Pool acotado por worker, compartido por todos los batches
+    global _batch_pool, _batch_pool_pid
+    with _batch_pool_lock:
+        if _batch_pool is None or _batch_pool_pid != os.getpid():
+            _batch_pool = ThreadPoolExecutor(
+                max_workers=_settings.batch_pool_size, thread_name_prefix="batch"
+            )
+            _batch_pool_pid = os.getpid()
+    return _batch_pool
+
+def _charge_batch_item(index, item, batch_key=None):
+    """Un cargo del lote; cualquier error queda en su resultado, nunca corta el lote"""
+    if not isinstance(item, dict):
+        return {"index": index, "http_status": 400, "error": "cada cargo debe ser un objeto"}
+    try:
+        key = item.get("idempotency_key")
+        # En un job, un cargo sin key deriva uno estable del job: el reintento tras una caída no cobra dos veces
+        if key is None and batch_key:
+            key = f"{batch_key}:{index}"
+        body, status = _charge_saved_card(item, idempotency_key=square_key(key))
+    except Exception as e:
+        log.error("batch_item_failed", exc=e, index=index)
+        body, status = {"status": "FAILED", "code": "SERVER_ERROR", "error": str(e)}, 500
+    return {"index": index, "http_status": status, **body}
+
+def _run_batch(charges, concurrency, batch_key=None):
+    """Generador de resultados en orden de terminación; nunca más de `concurrency` en vuelo"""
+    pool = _get_batch_pool()
+    items = iter(enumerate(charges))
+    pending = set()
+
+    def submit_next():
+        item = next(items, None)
+        if item is not None:
+            pending.add(pool.submit(_charge_batch_item, *item, batch_key))
+
+    for _ in range(concurrency):
+        submit_next()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            submit_next()
+            yield future.result()
+
+def _batch_summary(results):
+    results = sorted(results, key=lambda r: r["index"])
+    succeeded = sum(1 for r in results if r.get("success"))
+    return {"total": len(results), "succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+def _batch_job(args, key):
+    return _batch_summary(_run_batch(args["charges"], args["concurrency"], batch_key=key)), 200
+
+jobs.register("batch", _batch_job)
+
+@app.post("/api/payments/batch")
+def charge_batch():
+    """Cobros card-on-file en lote. ?stream=1 (o Accept: application/x-ndjson) → NDJSON al terminar cada uno.
+    Más de BATCH_SYNC_MAX_ITEMS cargos (o ?async=1) → 202 + /api/payments/jobs/<id>"""
+    if (k := require_key()): return k
+    data = request.get_json() or {}
+    charges = data.get("charges")
+    
+    if not isinstance(charges, list) or not charges:
+        return jsonify({"error": "charges (lista) requerido"}), 400
+    if len(charges) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"máximo {BATCH_MAX_ITEMS} cargos por lote"}), 400
+    try:
+        concurrency = max(1, min(int(data.get("concurrency", BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY))
+    except (ValueError, TypeError):
+        return jsonify({"error": "concurrency inválido"}), 400
+    
+    if len(charges) > BATCH_SYNC_MAX_ITEMS or request.args.get("async") == "1":
+        return _accept_job("batch", {"charges": charges, "concurrency": concurrency})
+    
+    results = _run_batch(charges, concurrency)
+    
+    if request.args.get("stream") == "1" or request.accept_mimetypes.best == "application/x-ndjson":
+        return app.response_class(
+            (app.json.dumps(r) + "\n" for r in results), mimetype="application/x-ndjson"
+        )
+    
+    return jsonify(_batch_summary(results)), 200
+
+# Página de tokenización: cargada una vez, gzip/br pre-comprimidos, ETag por contenido
+_card_page = StaticPage(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "card.html"),
+    max_age=_settings.sdk_card_max_age,
+)
 
 @app.get("/sdk/card")
 def sdk_card():
     """Servir HTML con Square Web Payments SDK para tokenización"""
-    try:
-        with open('templates/card.html', 'r') as f:
-            html_content = f.read()
-        return html_content, 200, {'Content-Type': 'text/html'}
-    except FileNotFoundError:
+    if not _card_page.loaded:
+        return jsonify({"error": "Card HTML not found"}), 404
+    return _card_page.response(request)
+
+@app.post("/sdk/card/reload")
+def sdk_card_reload():
+    """Releer templates/card.html en este worker (para todos: kill -HUP al master de gunicorn)"""
+    if (k := require_key()): return k
+    if not _card_page.reload():
         return jsonify({"error": "Card HTML not found"}), 404
+    return jsonify({"reloaded": True, **_card_page.stats()}), 200
 
 @app.post("/api/customers")
 def api_customers():
@@ -400,10 +827,11 @@ def fail(code, msg, http=422):
     return jsonify({"status":"FAILED","code":code,"message":msg}), http
 
 @app.post("/api/payments")
+@idempotent
+@limiter.limit
 def api_payments():
     if (k := require_key()): return k
     data = request.get_json() or {}
-    print(f"🔥 DATOS RECIBIDOS: {data}")
     
     amount = data.get("amount_cents")
     currency = data.get("currency", "USD")
@@ -412,9 +840,8 @@ def api_payments():
     customer_id = data.get("customer_id")
     card_id = data.get("card_id")
     
-    print(f"🎯 SOURCE_ID: '{source_id}' (tipo: {type(source_id)})")
-    print(f"💰 AMOUNT: {amount}")
-    print(f"👤 CUSTOMER_ID: {customer_id}")
+    log.info("payment_received", amount=amount, currency=currency, customer_id=customer_id,
+             card_id=card_id, has_source=bool(source_id))
 
     # 🔒 Validación fuerte de nonce en SANDBOX
     if not source_id and not card_id:
@@ -433,28 +860,42 @@ def api_payments():
     except (ValueError, TypeError):
         return fail("BAD_AMOUNT", f"Monto inválido: {amount}")
 
+    args = {"amount": amount, "currency": currency, "note": note,
+            "source_id": source_id, "customer_id": customer_id, "card_id": card_id}
+    if _wants_async():
+        return _accept_job("payment", args)
+    body, status = _execute_payment(args, current_key())
+    return jsonify(body), status
+
+def _execute_payment(args, idempotency_key=None):
+    """Pago ya validado → (body, http_status). Lo usan /api/payments y la cola de jobs"""
+    amount, currency, note = args["amount"], args["currency"], args["note"]
+    source_id, customer_id, card_id = args["source_id"], args["customer_id"], args["card_id"]
     try:
         # Dos modos: Card on File o Nonce directo
         if card_id and customer_id:
-            p = create_payment_with_card(customer_id, card_id, amount, currency, note)
+            p = create_payment_with_card(customer_id, card_id, amount, currency, note, idempotency_key=idempotency_key)
         else:
-            p = create_payment_with_nonce(source_id, amount, currency, note, customer_id=customer_id)
+            p = create_payment_with_nonce(source_id, amount, currency, note, customer_id=customer_id, idempotency_key=idempotency_key)
         
         # Si hay error en la respuesta
         if "error" in p:
-            return jsonify({
+            return {
                 "status": "FAILED",
-                "code": "SQUARE_ERROR",
+                # retry_after → circuito abierto o sin cupo, no se llamó a Square
+                "code": p["error"]["errors"][0]["code"] if "retry_after" in p else "SQUARE_ERROR",
                 "message": str(p["error"])
-            }), p.get("status_code", 400)
+            }, p.get("status_code", 400)
         
         # ✅ Devolver TODO el objeto payment de Square
-        return jsonify({"payment": p}), 200
+        return {"payment": p}, 200
             
     except Exception as e:
-        return fail("SERVER_ERROR", str(e), 500)
+        return {"status": "FAILED", "code": "SERVER_ERROR", "message": str(e)}, 500
 
 @app.post("/api/payments/charge-onfile")
+@idempotent
+@limiter.limit
 def api_payments_charge_onfile():
     """Cobrar tarjeta guardada (Card on File)"""
     data = request.get_json() or {}
@@ -470,7 +911,7 @@ def api_payments_charge_onfile():
         amount_cents = amount_money.get("amount", 0)
         currency = amount_money.get("currency", "USD")
         
-        payment = create_payment_with_card(customer_id, card_id, amount_cents, currency, note)
+        payment = create_payment_with_card(customer_id, card_id, amount_cents, currency, note, idempotency_key=current_key())
         
         return jsonify({
             "status": payment["status"],
@@ -486,67 +927,236 @@ def api_payments_charge_onfile():
         }), 400
 
 @app.route("/api/payments/charge-card-on-file", methods=["POST"])
+@idempotent
+@limiter.limit
 def charge_card_on_file():
     """Cobrar tarjeta guardada (Card on File) - SIN FORMULARIO"""
     try:
         data = request.get_json(force=True)
-        print(f"🔥 COBRO CARD ON FILE: {data}")
-        
-        amount = int(data["amount"])
-        currency = data.get("currency", "USD")
-        customer_id = data["customer_id"]
-        card_id = data["card_id"]
-        note = data.get("note", "")
         
-        # ✅ Obtener ZIP code de Supabase para la tarjeta
-        try:
-            # Llamar al backend system para obtener info de la tarjeta
-            card_response = requests.get(
-                f"https://cubalink23-system.onrender.com/api/users/{customer_id}/cards/{card_id}",
-                timeout=5
-            )
-            zip_code = "12345"  # Por defecto
-            if card_response.status_code == 200:
-                card_data = card_response.json()
-                zip_code = card_data.get("zip_code", "12345")
-                print(f"📮 ZIP code obtenido: {zip_code}")
-        except:
-            zip_code = "12345"  # Fallback
+        args = {
+            "amount": int(data["amount"]),
+            "currency": data.get("currency", "USD"),
+            "customer_id": data["customer_id"],
+            "card_id": data["card_id"],
+            "note": data.get("note", ""),
+        }
+    except Exception as e:
+        log.warning("charge_card_on_file_bad_request", exc=e)
+        return jsonify({
+            "ok": False,
+            "status_code": 500,
+            "square": {"error": str(e)}
+        }), 500
+    
+    if _wants_async():
+        return _accept_job("charge_card_on_file", args)
+    body, status = _charge_card_on_file(args, current_key())
+    return jsonify(body), status
+
+def _charge_card_on_file(args, idempotency_key=None):
+    """Cobro card-on-file ya validado → (body, http_status)"""
+    amount, currency, note = args["amount"], args["currency"], args["note"]
+    customer_id, card_id = args["customer_id"], args["card_id"]
+    try:
+        # ✅ ZIP code guardado en payment_cards (índice local, Supabase solo en un miss)
+        zip_code = _card_zip(card_id)
         
         # ✅ Usar función existente con ZIP code
-        payment = create_payment_with_card(customer_id, card_id, amount, currency, note)
+        payment = create_payment_with_card(customer_id, card_id, amount, currency, note,
+                                           idempotency_key=idempotency_key, postal_code=zip_code)
         
         if "error" in payment:
-            return jsonify({
+            return {
                 "ok": False,
                 "status_code": payment.get("status_code", 400),
                 "square": payment["error"]
-            }), payment.get("status_code", 400)
+            }, payment.get("status_code", 400)
         
         # Verificar status
         status = payment.get("status")
         ok = status == "COMPLETED"
         
-        return jsonify({
+        return {
             "ok": ok,
             "status_code": 200 if ok else 400,
             "square": {"payment": payment}
-        }), (200 if ok else 400)
+        }, (200 if ok else 400)
         
     except Exception as e:
-        print(f"❌ Error en Card on File: {e}")
-        return jsonify({
+        log.error("charge_card_on_file_failed", exc=e, customer_id=customer_id, card_id=card_id)
+        return {
             "ok": False,
             "status_code": 500,
             "square": {"error": str(e)}
-        }), 500
+        }, 500
+
+# ====================== PAGOS ASÍNCRONOS (202 + polling) ======================
+jobs.register("payment", _execute_payment)
+jobs.register("charge_card_on_file", _charge_card_on_file)
+
+def _wants_async():
+    """?async=1, "async": true en el body o Prefer: respond-async"""
+    if request.args.get("async") == "1" or "respond-async" in request.headers.get("Prefer", ""):
+        return True
+    data = request.get_json(force=True, silent=True)
+    return isinstance(data, dict) and data.get("async") is True
+
+def _accept_job(kind, args):
+    # El idempotency key se fija aquí y queda en el journal: un reintento tras
+    # caída del worker llega a Square con el mismo key
+    job_id = jobs.get_jobs().submit(kind, args, current_key() or square_key())
+    status_url = f"/api/payments/jobs/{job_id}"
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": status_url}), 202, {"Location": status_url}
+
+@app.get("/api/payments/jobs/<job_id>")
+def payment_job_status(job_id):
+    """Estado de un pago asíncrono; `result` es la misma respuesta del modo síncrono"""
+    job = jobs.get_jobs().get(job_id)
+    if job is None:
+        return jsonify({"error": "Job no encontrado"}), 404
+    return jsonify(job), 200
+
+# ====================== WEBHOOKS DE SQUARE ======================
+@app.post("/webhooks/square")
+def square_webhook():
+    """Verificar firma, encolar y responder; el upsert a Supabase lo hace el flusher en lote"""
+    settings = get_settings()
+    body = request.get_data(cache=False)
+    if not webhooks.signature_valid(
+        settings.square_webhook_signature_key, settings.square_webhook_url or request.url,
+        body, request.headers.get("x-square-hmacsha256-signature", ""),
+    ):
+        return jsonify({"error": "firma inválida"}), 401
+    try:
+        event = app.json.loads(body)
+    except ValueError:
+        event = None
+    if not isinstance(event, dict) or not event.get("event_id"):
+        return jsonify({"error": "evento inválido"}), 400
+    
+    queue = webhooks.get_webhooks()
+    queue.start(get_supabase, _sb)
+    if not queue.put(event):
+        # Cola llena: Square reintenta más tarde
+        return jsonify({"error": "cola llena"}), 503, {"Retry-After": "5"}
+    return "", 200
+
+@app.get("/api/payments/status")
+def payment_status():
+    """Estado de un pago según los webhooks (?payment_id= o ?order_id= del payment link)"""
+    if get_supabase() is None:
+        return jsonify({"error": "Supabase no configurado"}), 500
+    payment_id, order_id = request.args.get("payment_id"), request.args.get("order_id")
+    if not payment_id and not order_id:
+        return jsonify({"error": "payment_id u order_id requerido"}), 400
+    query = get_supabase().table("square_payments").select(
+        "payment_id, status, amount, currency, order_id, receipt_url, square_updated_at"
+    )
+    query = query.eq("payment_id", payment_id) if payment_id else query.eq("order_id", order_id)
+    result = _sb(query.order("square_updated_at", desc=True).limit(1))
+    if not result.data:
+        return jsonify({"status": "UNKNOWN"}), 404
+    return jsonify(result.data[0]), 200
+
+# ====================== SYNC DE TARJETAS CON SQUARE ======================
+def _on_cards_synced(user_ids, square_card_ids):
+    for user_id in user_ids:
+        _invalidate_user_cards(user_id)
+    for square_card_id in square_card_ids:
+        _card_owners.pop(square_card_id)
+
+@app.before_request
+def _start_background():
+    # Después del fork de gunicorn; no-op tras la primera vez en cada worker
+    card_sync.get_card_sync().start(get_supabase, _sb, _on_cards_synced, interval=_settings.card_sync_interval)
+    _link_pool.start()
+    get_prober().start()
+    # Jobs 202 que quedaron en cola o corriendo en un proceso muerto: no esperar al próximo polling
+    jobs.get_jobs().start()
+    # Siempre: drena también filas que quedaron de antes de cambiar SUPABASE_OUTBOX
+    outbox.get_outbox().start(ready=lambda: get_supabase() is not None)
+
+def _card_sync_job(args, key):
+    if get_supabase() is None:
+        return {"status": "FAILED", "code": "SUPABASE_UNAVAILABLE", "message": "Supabase no configurado"}, 503
+    return card_sync.get_card_sync().run_full(get_supabase, _sb, _on_cards_synced), 200
+
+jobs.register("card_sync", _card_sync_job)
+
+@app.post("/api/cards/sync")
+def run_card_sync():
+    """Pasada completa del sync Square → payment_cards (202 + /api/payments/jobs/<id>)"""
+    if (k := require_key()): return k
+    return _accept_job("card_sync", {})
+
+# ====================== EXPORT / CONCILIACIÓN ======================
+@app.get("/api/payments/export")
+def export_payments():
+    """Pagos de Square en streaming. ?begin_time=&end_time= (RFC 3339) &format=ndjson|csv &sort_order=ASC|DESC"""
+    if (k := require_key()): return k
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format debe ser ndjson o csv"}), 400
+    payments = list_payments(
+        begin_time=request.args.get("begin_time"), end_time=request.args.get("end_time"),
+        sort_order=request.args.get("sort_order", "ASC"),
+    )
+    # Primera página antes de responder: un error de Square todavía puede ser un status HTTP
+    try:
+        first = next(payments, None)
+    except UpstreamUnavailable as e:
+        return _unavailable(e)
+    except requests.HTTPError as e:
+        return jsonify({"status": "FAILED", "code": "SQUARE_ERROR", "message": "Square rechazó el listado",
+                        "square_status": e.response.status_code}), 502
+    except requests.RequestException as e:
+        log.error("payments_export_failed", exc=e)
+        return jsonify({"status": "FAILED", "code": "SQUARE_UNREACHABLE", "message": str(e)}), 502
+    rows = payments if first is None else chain([first], payments)
+
+    def stream():
+        try:
+            yield from (reconcile.export_csv if fmt == "csv" else reconcile.export_ndjson)(rows)
+        except Exception as e:
+            # Ya se envió el 200: se corta el stream y queda en el log
+            log.error("payments_export_aborted", exc=e)
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return app.response_class(stream(), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=payments.{fmt}",
+    })
+
+def _reconcile_job(args, key):
+    if get_supabase() is None:
+        return {"status": "FAILED", "code": "SUPABASE_UNAVAILABLE", "message": "Supabase no configurado"}, 503
+    return reconcile.get_reconciler().run(get_supabase, _sb, end_time=args.get("end_time")), 200
+
+jobs.register("reconcile", _reconcile_job)
+
+@app.post("/api/payments/reconcile")
+def run_reconcile():
+    """Pasada incremental de conciliación (202 + /api/payments/jobs/<id>)"""
+    if (k := require_key()): return k
+    data = request.get_json(silent=True) or {}
+    return _accept_job("reconcile", {"end_time": data.get("end_time")})
+
+@app.get("/api/payments/reconcile/mismatches")
+def reconcile_mismatches():
+    if (k := require_key()): return k
+    r = reconcile.get_reconciler()
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+    except ValueError:
+        return jsonify({"error": "limit inválido"}), 400
+    since, _ = r.cursor()
+    return jsonify({"cursor": since, "mismatches": r.mismatches(limit, request.args.get("kind"))}), 200
 
 @app.route("/api/cards/create", methods=["POST"])
 def create_card():
     """Crear tarjeta EN Square y devolver card.id real"""
     try:
         data = request.get_json(force=True)
-        print(f"🔥 CREAR TARJETA EN SQUARE: {data}")
         
         nonce = data["nonce"]
         customer_id = data["customer_id"]
@@ -570,7 +1180,7 @@ def create_card():
         }), 200
         
     except Exception as e:
-        print(f"❌ Error creando tarjeta: {e}")
+        log.error("create_square_card_failed", exc=e)
         return jsonify({
             "ok": False,
             "square": {"error": str(e)}
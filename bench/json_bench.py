@@ -0,0 +1,108 @@
+"""Micro-benchmark del JSON de la app: provider por defecto de Flask vs json_provider.FastJSONProvider.
+
+    python bench/json_bench.py                    # payloads de Square, 2000 iteraciones
+    python bench/json_bench.py --number 5000 --payments 100
+
+Payloads: respuesta de CreatePayment (/api/payments devuelve el `payment` entero),
+una página de ListPayments y el listado de /api/cards. Reporta µs por operación
+para dumps, loads y jsonify (respuesta completa) y la aceleración.
+"""
+import argparse, os, sys, timeit, uuid
+from flask import Flask, jsonify
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_provider import FastJSONProvider
+
+def square_payment(i=0):
+    """Forma de un Payment de Square (v2/payments) con tarjeta guardada"""
+    created = f"2026-10-17T12:{i % 60:02d}:00.123Z"
+    return {
+        "id": f"R2B3Z8WMVt3EAmzYWLZvz7Y69{i:04d}",
+        "created_at": created,
+        "updated_at": created,
+        "amount_money": {"amount": 2500 + i, "currency": "USD"},
+        "total_money": {"amount": 2500 + i, "currency": "USD"},
+        "approved_money": {"amount": 2500 + i, "currency": "USD"},
+        "status": "COMPLETED",
+        "delay_duration": "PT168H",
+        "delay_action": "CANCEL",
+        "delayed_until": "2026-10-24T12:00:00.123Z",
+        "source_type": "CARD",
+        "card_details": {
+            "status": "CAPTURED",
+            "card": {
+                "id": f"ccof:{uuid.UUID(int=i).hex[:16]}",
+                "card_brand": "VISA",
+                "last_4": "1111",
+                "exp_month": 12,
+                "exp_year": 2029,
+                "fingerprint": "sq-1-" + "x" * 60,
+                "card_type": "CREDIT",
+                "prepaid_type": "NOT_PREPAID",
+                "bin": "411111",
+            },
+            "entry_method": "ON_FILE",
+            "cvv_status": "CVV_ACCEPTED",
+            "avs_status": "AVS_ACCEPTED",
+            "statement_description": "SQ *CUBALINK23",
+            "card_payment_timeline": {"authorized_at": created, "captured_at": created},
+        },
+        "location_id": "L88917AVBK2S5",
+        "order_id": f"pRsjRTgFWATl7so6DxdKBJa7ss{i:04d}",
+        "reference_id": str(uuid.UUID(int=i)),
+        "customer_id": "JDKYHBWT1D4F8MFH63DBMEN8Y4",
+        "note": "Recarga Cubalink23 — saldo móvil",
+        "risk_evaluation": {"created_at": created, "risk_level": "NORMAL"},
+        "receipt_number": "R2B3",
+        "receipt_url": f"https://squareup.com/receipt/preview/R2B3Z8WMVt3EAmzYWLZvz7Y69{i:04d}",
+        "application_details": {"square_product": "ECOMMERCE_API", "application_id": "sq0idp-fake"},
+        "version_token": "TPtNEOBOa6Qq6E3C3IjckSVOM6b3hMbfhjvTxHBQUsB6o",
+    }
+
+def cards_list(n=5):
+    return {"cards": [{
+        "id": i, "square_card_id": f"ccof:{uuid.UUID(int=i).hex[:16]}", "brand": "VISA", "last4": "1111",
+        "exp_month": 12, "exp_year": 2029, "is_default": i == 0, "holder_name": "José Pérez",
+        "created_at": "2026-10-17T12:00:00.123456+00:00",
+    } for i in range(n)]}
+
+def _bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--payments", type=int, default=100, help="pagos en la página de ListPayments")
+    args = parser.parse_args()
+
+    payloads = {
+        "payment": {"payment": square_payment()},
+        f"list_payments[{args.payments}]": {"payments": [square_payment(i) for i in range(args.payments)], "cursor": "x" * 40},
+        "cards[5]": cards_list(),
+    }
+    providers = {}
+    for name, cls in (("flask", DefaultJSONProvider), ("fast", FastJSONProvider)):
+        app = Flask(name)
+        app.json = cls(app)
+        providers[name] = app
+
+    print(f"backend: {FastJSONProvider.backend}   (µs por operación, mejor de 3)")
+    print(f"{'payload':<22}{'op':<9}{'flask':>10}{'fast':>10}{'x':>7}")
+    for label, obj in payloads.items():
+        raw = providers["flask"].json.dumps(obj).encode()
+        number = max(1, args.number // (args.payments if label.startswith("list") else 1))
+        ops = {
+            "dumps": lambda app: app.json.dumps(obj),
+            "loads": lambda app: app.json.loads(raw),
+            "jsonify": lambda app: jsonify(obj).get_data(),
+        }
+        for op, fn in ops.items():
+            results = {}
+            for name, app in providers.items():
+                with app.app_context():
+                    results[name] = _bench(lambda: fn(app), number)
+            print(f"{label:<22}{op:<9}{results['flask']:>10.1f}{results['fast']:>10.1f}{results['flask'] / results['fast']:>7.1f}")
+
+if __name__ == "__main__":
+    main()
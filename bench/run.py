@@ -0,0 +1,231 @@
+"""Benchmark de carga de app.py contra el stand-in local (bench/fake_upstream.py).
+
+    python bench/run.py                                  # arranca fake + gunicorn, todas las rutas
+    python bench/run.py --routes payments_charge,cards_list --concurrency 1,16,64 --requests 500
+    python bench/run.py --async --workers 2 --square-latency-ms 200 --json results.json
+    python bench/run.py --baseline results.json          # exit 1 si p95/rps empeoran > --tolerance
+    python bench/run.py --target http://127.0.0.1:8000   # app ya levantada (apuntando a un fake)
+
+Reporta por ruta y nivel de concurrencia: p50, p95, p99 (ms), req/s y errores.
+No se ejercitan DELETE /api/cards/<id> ni /debug/users (destructivo / solo debug).
+"""
+import argparse, json, os, socket, subprocess, sys, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from fake_upstream import FAKE_SUPABASE_KEY
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} no respondió en {timeout}s")
+
+# ====================== ESCENARIOS ======================
+
+class Fixture:
+    """Usuarios/clientes/tarjetas creados una vez a través de la propia app"""
+
+    def __init__(self, base, users=20):
+        self.base = base
+        self.users = []
+        s = requests.Session()
+        for i in range(users):
+            user_id = str(uuid.uuid4())
+            r = s.post(f"{base}/api/square/customers/ensure", json={"user_id": user_id, "email": f"bench{i}@example.com", "name": f"Bench {i}"})
+            r.raise_for_status()
+            customer_id = r.json()["square_customer_id"]
+            r = s.post(f"{base}/api/cards/create", json={
+                "user_id": user_id, "customer_id": customer_id, "nonce": f"cnon:bench-{uuid.uuid4().hex}",
+                "postal_code": "33101", "name": f"Bench {i}",
+            })
+            r.raise_for_status()
+            self.users.append({"user_id": user_id, "customer_id": customer_id, "card_id": r.json()["square_card_id"]})
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+def _nonce():
+    return f"cnon:bench-{uuid.uuid4().hex}"
+
+def scenarios(fx):
+    """nombre -> fn(i) -> (method, path, json)"""
+    def charge(u):
+        return {"user_id": u["user_id"], "amount": 500, "square_card_id": u["card_id"], "customer_id": u["customer_id"]}
+    return {
+        "ping": lambda i: ("GET", "/__ping", None),
+        "health": lambda i: ("GET", "/health", None),
+        "sdk_card": lambda i: ("GET", "/sdk/card", None),
+        "customers_ensure": lambda i: ("POST", "/api/square/customers/ensure", {"user_id": fx.user(i)["user_id"]}),
+        "customers_create": lambda i: ("POST", "/api/customers", {"name": "Bench", "reference_id": str(i)}),
+        "cards_list": lambda i: ("GET", f"/api/cards?user_id={fx.user(i)['user_id']}", None),
+        "cards_create": lambda i: ("POST", "/api/cards/create", {
+            "user_id": fx.user(i)["user_id"], "customer_id": fx.user(i)["customer_id"], "nonce": _nonce(), "postal_code": "33101"}),
+        "cards_raw": lambda i: ("POST", "/api/cards", {"customer_id": fx.user(i)["customer_id"], "nonce": _nonce()}),
+        "cards_save": lambda i: ("POST", "/api/cards/save", {"customer_id": fx.user(i)["customer_id"], "source_id": _nonce()}),
+        "payments_nonce": lambda i: ("POST", "/api/payments", {"amount_cents": 500, "source_id": _nonce()}),
+        "payments_charge": lambda i: ("POST", "/api/payments/charge", charge(fx.user(i))),
+        "payments_charge_onfile": lambda i: ("POST", "/api/payments/charge-onfile", {
+            "customer_id": fx.user(i)["customer_id"], "card_id": fx.user(i)["card_id"], "amount_money": {"amount": 500, "currency": "USD"}}),
+        "payments_charge_card_on_file": lambda i: ("POST", "/api/payments/charge-card-on-file", {
+            "customer_id": fx.user(i)["customer_id"], "card_id": fx.user(i)["card_id"], "amount": 500}),
+        "payments_batch": lambda i: ("POST", "/api/payments/batch", {"charges": [charge(fx.user(i + k)) for k in range(10)]}),
+        "payment_links": lambda i: ("POST", "/api/payment-links/create", {"amount": 1000}),
+    }
+
+# ====================== CARGA ======================
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def run_level(base, build, concurrency, total):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+    local = threading.local()
+
+    def worker():
+        nonlocal errors
+        session = getattr(local, "session", None) or requests.Session()
+        local.session = session
+        for i in counter:
+            method, path, body = build(i)
+            start = time.perf_counter()
+            try:
+                ok = session.request(method, base + path, json=body, timeout=60).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for f in [pool.submit(worker) for _ in range(concurrency)]:
+            f.result()
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / wall, 1) if wall else None,
+        "p50_ms": ms(_percentile(latencies, 0.50)),
+        "p95_ms": ms(_percentile(latencies, 0.95)),
+        "p99_ms": ms(_percentile(latencies, 0.99)),
+    }
+
+def compare(results, baseline, tolerance):
+    """Regresiones: p95 más alto o rps más bajo que la línea base más allá de la tolerancia"""
+    old = {(r["route"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = old.get((r["route"], r["concurrency"]))
+        if not b:
+            continue
+        if b["p95_ms"] and r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{r['route']} c={r['concurrency']}: p95 {b['p95_ms']} → {r['p95_ms']} ms")
+        if b["rps"] and r["rps"] < b["rps"] * (1 - tolerance):
+            regressions.append(f"{r['route']} c={r['concurrency']}: rps {b['rps']} → {r['rps']}")
+    return regressions
+
+# ====================== PROCESOS ======================
+
+def start_stack(args):
+    """Arranca fake_upstream + gunicorn app:app; devuelve (base_url, procesos)"""
+    fake_port, app_port = _free_port(), _free_port()
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "bench", "fake_upstream.py"), "--port", str(fake_port),
+         "--square-latency-ms", str(args.square_latency_ms), "--supabase-latency-ms", str(args.supabase_latency_ms),
+         "--square-error-rate", str(args.square_error_rate), "--supabase-error-rate", str(args.supabase_error_rate)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    _wait_ready(f"{fake_url}/v2/locations/LFAKE")
+    env = dict(
+        os.environ,
+        SQUARE_BASE_URL=fake_url, SQUARE_ACCESS_TOKEN="bench", SQUARE_LOCATION_ID="LFAKE",
+        SUPABASE_URL=fake_url, SUPABASE_KEY=FAKE_SUPABASE_KEY, WEB_CONCURRENCY=str(args.workers),
+        # Medir la app, no el rate limiter (los escenarios repiten pocos usuarios)
+        RATE_LIMIT_USER="0", RATE_LIMIT_API_KEY="0",
+    )
+    if args.async_mode:
+        env["GUNICORN_ASYNC"] = "1"
+    app = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{app_port}"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{app_port}"
+    _wait_ready(f"{base}/__ping")
+    return base, [app, fake]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", help="URL de una app ya levantada (si no, se arranca fake + gunicorn)")
+    parser.add_argument("--routes", help="lista separada por comas (default: todas)")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=200, help="requests por ruta y nivel")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="GUNICORN_ASYNC=1 (gevent)")
+    parser.add_argument("--square-latency-ms", type=float, default=100)
+    parser.add_argument("--supabase-latency-ms", type=float, default=15)
+    parser.add_argument("--square-error-rate", type=float, default=0)
+    parser.add_argument("--supabase-error-rate", type=float, default=0)
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    parser.add_argument("--baseline", help="resultados previos (--json) para detectar regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    procs = []
+    try:
+        if args.target:
+            base = args.target.rstrip("/")
+        else:
+            base, procs = start_stack(args)
+        fx = Fixture(base, users=args.users)
+        all_scenarios = scenarios(fx)
+        names = args.routes.split(",") if args.routes else list(all_scenarios)
+        levels = [int(c) for c in args.concurrency.split(",")]
+
+        results = []
+        print(f"{'route':32} {'conc':>5} {'reqs':>6} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for name in names:
+            for concurrency in levels:
+                r = {"route": name, "concurrency": concurrency, **run_level(base, all_scenarios[name], concurrency, args.requests)}
+                results.append(r)
+                print(f"{name:32} {concurrency:>5} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8} "
+                      f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}", flush=True)
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.tolerance)
+            for line in regressions:
+                print(f"❌ REGRESIÓN {line}")
+            if regressions:
+                sys.exit(1)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait(timeout=10)
+
+if __name__ == "__main__":
+    main()
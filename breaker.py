@@ -0,0 +1,145 @@
+"""Circuit breaker + latencias por upstream (square, supabase).
+
+Con muchos errores o llamadas lentas en la ventana reciente el circuito se abre
+y las llamadas fallan al instante (UpstreamUnavailable) en vez de esperar el
+timeout completo; tras <UPSTREAM>_BREAKER_OPEN_SECONDS se deja pasar una sonda (half-open).
+El read timeout de Square se deriva del p99 observado.
+"""
+import time, threading
+from collections import deque
+from settings import get_settings
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+class UpstreamUnavailable(Exception):
+    """Circuito abierto: no se llamó al upstream"""
+    code = "UPSTREAM_UNAVAILABLE"
+    status_code = 503
+
+    def __init__(self, upstream:str, retry_after:float):
+        self.upstream = upstream
+        self.retry_after = retry_after
+        super().__init__(f"{upstream} no disponible (circuito abierto), reintentar en {retry_after:.0f}s")
+
+
+class CircuitBreaker:
+    def __init__(self, name:str, window=50, min_calls=20, error_rate=0.5, slow_rate=0.5,
+                 slow_call=5.0, open_seconds=30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.failures = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)     # (error, slow)
+        self._latencies = deque(maxlen=window * 4)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # ---------------- estado ----------------
+
+    def before_call(self):
+        """Lanza UpstreamUnavailable si el circuito no deja pasar la llamada; True si esta es la sonda"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if self.state == OPEN and remaining <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            raise UpstreamUnavailable(self.name, max(remaining, 1.0))
+
+    def release_probe(self):
+        """La sonda terminó sin resultado (cancelada): la próxima llamada vuelve a sondear"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, latency:float, error:bool):
+        slow = latency >= self.slow_call
+        with self._lock:
+            self._latencies.append(latency)
+            if error:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if error or slow:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append((error, slow))
+            n = len(self._outcomes)
+            if self.state == CLOSED and n >= self.min_calls:
+                errors = sum(1 for e, _ in self._outcomes if e)
+                slows = sum(1 for _, s in self._outcomes if s)
+                if errors / n >= self.error_rate or slows / n >= self.slow_rate:
+                    self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def call(self, fn, *args, is_error=None, ignore=(), **kwargs):
+        """Ejecutar fn bajo el breaker. is_error(resultado) marca respuestas fallidas (ej. 5xx);
+        excepciones en `ignore` (tupla de tipos o predicado ignore(exc)) son respuestas del
+        upstream (ej. error de validación), no fallas"""
+        probe = self.before_call()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except UpstreamUnavailable:
+            if probe:
+                self.release_probe()
+            raise
+        except Exception as e:
+            ignored = ignore(e) if callable(ignore) else isinstance(e, ignore)
+            self.record(time.perf_counter() - start, not ignored)
+            raise
+        except BaseException:
+            # CancelledError / gevent.Timeout: no dice nada del upstream, pero una sonda
+            # sin liberar dejaría el circuito en half_open para siempre
+            if probe:
+                self.release_probe()
+            raise
+        self.record(time.perf_counter() - start, bool(is_error and is_error(result)))
+        return result
+
+    # ---------------- latencias ----------------
+
+    def percentile(self, q:float):
+        with self._lock:
+            data = sorted(self._latencies)
+        if not data:
+            return None
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+    def adaptive_timeout(self, floor:float, ceiling:float, factor:float=3.0):
+        """factor × p99 observado, acotado a [floor, ceiling]; ceiling sin datos suficientes"""
+        if len(self._latencies) < self.min_calls:
+            return ceiling
+        return max(floor, min(ceiling, self.percentile(0.99) * factor))
+
+    def snapshot(self):
+        p50, p99 = self.percentile(0.5), self.percentile(0.99)
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+        }
+
+
+breakers = {name: CircuitBreaker(name, **config) for name, config in get_settings().breakers.items()}
+
+def get_breaker(name:str) -> CircuitBreaker:
+    return breakers[name]
@@ -0,0 +1,177 @@
+"""Sync de fondo: tarjetas de Square (/v2/cards) → payment_cards.status.
+
+Recorre /v2/cards (include_disabled) página por página y marca en Supabase
+las tarjetas deshabilitadas en Square ('disabled') o vencidas ('expired').
+Las escrituras van agrupadas por estado: un PATCH ... in (...) por página.
+El cursor de Square se guarda en CARD_SYNC_DB entre ticks, así cada tick hace a
+lo sumo CARD_SYNC_PAGES páginas y la siguiente pasada sigue donde quedó.
+
+Requiere sql/payment_cards_status.sql. Un solo worker de gunicorn corre el
+hilo (flock sobre CARD_SYNC_DB.lock); CARD_SYNC_INTERVAL=0 lo desactiva.
+"""
+import os, time, fcntl, threading
+from datetime import datetime, timezone
+from square_client import list_cards_page, disable_card
+from shared_store import SharedStore
+from settings import get_settings
+import log
+
+ACTIVE, EXPIRED, DISABLED = "active", "expired", "disabled"
+
+# card.reference_id de las tarjetas que /api/cards/create guarda en payment_cards.
+# Solo esas pueden quedar huérfanas: POST /api/cards y /api/cards/save no escriben fila.
+TRACKED_REFERENCE = "payment_cards"
+
+def card_status(card:dict, today=None):
+    if not card.get("enabled", True):
+        return DISABLED
+    today = today or datetime.now(timezone.utc)
+    exp_year, exp_month = card.get("exp_year"), card.get("exp_month")
+    # La tarjeta vale hasta el último día de su mes de vencimiento
+    if exp_year and exp_month and (int(exp_year), int(exp_month)) < (today.year, today.month):
+        return EXPIRED
+    return ACTIVE
+
+
+class CardSync:
+    def __init__(self, path:str, pages_per_tick:int=10, page_size:int=100, disable_orphans_after:float=0):
+        self.path = path
+        self.pages_per_tick = pages_per_tick
+        self.page_size = page_size
+        # >0: deshabilitar en Square tarjetas sin fila en payment_cards más viejas que esto (segundos);
+        # solo las creadas por /api/cards/create (reference_id = TRACKED_REFERENCE)
+        self.disable_orphans_after = disable_orphans_after
+        self.state = SharedStore(path)
+        self.stats = {"ticks": 0, "scanned": 0, "updated": 0, "orphans": 0, "orphans_disabled": 0,
+                      "last_tick_at": None, "last_full_pass_at": self.state.get("last_full_pass_at"), "last_error": None,
+                      "cursor": self.state.get("cursor")}
+        self._run_lock = threading.Lock()
+        self._started_pid = None
+        self._lock_file = None
+
+    # ---------------- una página ----------------
+
+    def _orphan_due(self, card, now):
+        if not self.disable_orphans_after or not card.get("enabled", True) or not card.get("created_at"):
+            return False
+        if card.get("reference_id") != TRACKED_REFERENCE:
+            return False
+        created = datetime.fromisoformat(card["created_at"].replace("Z", "+00:00"))
+        return (now - created).total_seconds() >= self.disable_orphans_after
+
+    def sync_page(self, cards, client, run, on_change=None):
+        """Compara una página de Square con payment_cards (1 select) y escribe los cambios (1 update por estado).
+        client() devuelve el cliente Supabase del worker; run(query) la ejecuta"""
+        if not cards:
+            return 0
+        rows = run(client().table("payment_cards").select("user_id, square_card_id, status")
+                   .in_("square_card_id", [c["id"] for c in cards])).data
+        by_id = {r["square_card_id"]: r for r in rows}
+        now = datetime.now(timezone.utc)
+        changes, users = {}, set()
+        for card in cards:
+            row = by_id.get(card["id"])
+            if row is None:
+                self.stats["orphans"] += 1
+                if self._orphan_due(card, now) and disable_card(card["id"]):
+                    self.stats["orphans_disabled"] += 1
+                continue
+            status = card_status(card, now)
+            if row.get("status") != status:
+                changes.setdefault(status, []).append(card["id"])
+                users.add(row["user_id"])
+        for status, ids in changes.items():
+            run(client().table("payment_cards").update({"status": status, "synced_at": now.isoformat()})
+                .in_("square_card_id", ids))
+        if users and on_change:
+            on_change(users, [i for ids in changes.values() for i in ids])
+        updated = sum(len(ids) for ids in changes.values())
+        self.stats["updated"] += updated
+        return updated
+
+    # ---------------- tick / pasada completa ----------------
+
+    def tick(self, client, run, on_change=None, max_pages=None):
+        """Hasta max_pages páginas desde el cursor guardado; al terminar el listado vuelve a empezar"""
+        with self._run_lock:
+            cursor = self.state.get("cursor")
+            scanned = updated = pages = 0
+            full_pass = False
+            while pages < (max_pages or self.pages_per_tick):
+                cards, next_cursor = list_cards_page(cursor, include_disabled=True, limit=self.page_size)
+                updated += self.sync_page(cards, client, run, on_change)
+                scanned += len(cards)
+                pages += 1
+                cursor = next_cursor
+                self.state.set("cursor", cursor)
+                self.stats["cursor"] = cursor
+                if cursor is None:
+                    full_pass = True
+                    self.stats["last_full_pass_at"] = time.time()
+                    self.state.set("last_full_pass_at", self.stats["last_full_pass_at"])
+                    break
+            self.stats["ticks"] += 1
+            self.stats["scanned"] += scanned
+            self.stats["last_tick_at"] = time.time()
+            log.info("card_sync_tick", scanned=scanned, updated=updated, pages=pages, full_pass=full_pass)
+            return {"scanned": scanned, "updated": updated, "pages": pages, "full_pass": full_pass}
+
+    def run_full(self, client, run, on_change=None):
+        """Pasada completa desde el principio (POST /api/cards/sync)"""
+        self.state.delete("cursor")
+        totals = {"scanned": 0, "updated": 0, "pages": 0}
+        while True:
+            r = self.tick(client, run, on_change, max_pages=1000)
+            for k in totals:
+                totals[k] += r[k]
+            if r["full_pass"]:
+                return totals
+
+    # ---------------- hilo de fondo ----------------
+
+    def start(self, client, run, on_change=None, interval:float=900):
+        """Una vez por proceso; solo el worker que toma el flock corre el loop"""
+        if self._started_pid == os.getpid() or interval <= 0:
+            return
+        self._started_pid = os.getpid()
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return
+        self._lock_file = lock_file  # mantener abierto: el lock vive con el proceso
+
+        def loop():
+            while True:
+                try:
+                    if client() is not None:  # sin Supabase (o reconectando): esperar al próximo tick
+                        self.tick(client, run, on_change)
+                        self.stats["last_error"] = None
+                except Exception as e:
+                    self.stats["last_error"] = str(e)
+                    log.error("card_sync_failed", exc=e)
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name="card-sync", daemon=True).start()
+
+    def snapshot(self):
+        return {**self.stats, "running": self._lock_file is not None}
+
+
+_sync = None
+_sync_lock = threading.Lock()
+
+def get_card_sync():
+    global _sync
+    if _sync is None:
+        with _sync_lock:
+            if _sync is None:
+                settings = get_settings()
+                _sync = CardSync(
+                    settings.card_sync_db,
+                    pages_per_tick=settings.card_sync_pages,
+                    page_size=settings.card_sync_page_size,
+                    disable_orphans_after=settings.card_sync_disable_orphans_after,
+                )
+    return _sync
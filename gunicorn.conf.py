@@ -0,0 +1,55 @@
+# Configuración de gunicorn (Procfile: gunicorn app:app -c gunicorn.conf.py)
+import os, time, shutil, tempfile
+
+_conf_loaded = time.monotonic()
+
+# Modo async: GUNICORN_ASYNC=1 → workers gevent. Cada request que espera a
+# Square/Supabase cede el worker en vez de bloquearlo, así un proceso mantiene
+# cientos de pagos en vuelo sin reescribir las rutas Flask (requests queda
+# cooperativo vía monkey-patching de gevent).
+_async = os.getenv("GUNICORN_ASYNC", "").lower() in ("1", "true", "yes")
+if _async:
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+# Preload: la app se importa una vez en el master y los workers nacen por fork
+# (arranque y scale-out más rápidos, memoria compartida). Los clientes de Square/
+# Supabase y los hilos de fondo se crean por worker después del fork.
+# Con gevent no: el monkey-patching debe ocurrir antes de importar la app.
+preload_app = os.getenv("GUNICORN_PRELOAD", "0" if _async else "1").lower() in ("1", "true", "yes")
+
+# Debe cubrir el read timeout de Square (30 s) + Supabase
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+
+# Métricas Prometheus agregadas entre workers: cada worker escribe en este
+# directorio. Se prepara al cargar esta config, antes del preload de la app
+# (on_starting corre después); no se limpia de nuevo en un reload por HUP.
+if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(tempfile.gettempdir(), f"cubalink23-metrics-{os.getpid()}")
+if os.getenv("_METRICS_DIR_READY") != os.environ["PROMETHEUS_MULTIPROC_DIR"]:
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    os.environ["_METRICS_DIR_READY"] = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+
+# En el worker que sale: los links del pool sin entregar se borran en Square
+def worker_exit(server, worker):
+    import link_pool
+    link_pool.shutdown()
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+# Tiempo de arranque: master (incluye importar la app con preload) y cada worker
+def when_ready(server):
+    server.log.info("master listo en %.3fs (preload=%s)", time.monotonic() - _conf_loaded, preload_app)
+
+def post_fork(server, worker):
+    worker.boot_started = time.monotonic()
+
+def post_worker_init(worker):
+    elapsed = time.monotonic() - worker.boot_started
+    from metrics import WORKER_BOOT
+    WORKER_BOOT.labels(str(preload_app).lower()).set(elapsed)
+    import log
+    log.info("worker_booted", seconds=round(elapsed, 4), preload=preload_app)
@@ -0,0 +1,78 @@
+"""Idempotency-Key del cliente → mismo key a Square + respuesta cacheada para reintentos."""
+import json, uuid, hashlib
+from functools import wraps
+from flask import request, g, current_app, jsonify
+from cache import TTLCache, SingleFlight
+from settings import get_settings
+
+# (key, fingerprint) -> (body, status, mimetype)
+_responses = TTLCache(
+    maxsize=get_settings().idempotency_cache_size,
+    ttl=get_settings().idempotency_ttl,
+)
+# key -> fingerprint del primer request (detectar reuso con otro body)
+_fingerprints = TTLCache(maxsize=_responses.maxsize, ttl=_responses.ttl)
+_inflight = SingleFlight()
+
+# Respuestas que el cliente puede corregir y reintentar con el mismo key
+_NOT_FINAL = {401, 429}
+
+def _client_key(data):
+    key = request.headers.get("Idempotency-Key") or (data.get("idempotency_key") if isinstance(data, dict) else None)
+    return str(key) if key else None
+
+def _fingerprint(data):
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k != "idempotency_key"}
+    raw = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{request.method} {request.path} {raw}".encode()).hexdigest()
+
+def square_key(key=None):
+    """Key para Square (máx. 45 chars); uuid4 nuevo si el cliente no mandó ninguno"""
+    if key is None or key == "":
+        return str(uuid.uuid4())
+    key = str(key)  # el cliente puede mandar un número
+    return key if len(key) <= 45 else str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+def current_key():
+    """Idempotency key de Square para el request actual (None → generar uno nuevo)"""
+    return g.get("idempotency_key")
+
+def idempotent(view):
+    """Decorador: reintentos con el mismo key (+ mismo body) se responden desde memoria.
+    Duplicados concurrentes esperan al primero en vez de ir a Square otra vez."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(force=True, silent=True)
+        key = _client_key(data)
+        if not key:
+            return view(*args, **kwargs)
+
+        fp = _fingerprint(data)
+        first_fp = _fingerprints.get(key)
+        if first_fp is None:
+            _fingerprints.set(key, fp)
+        elif first_fp != fp:
+            return jsonify({"status": "FAILED", "code": "IDEMPOTENCY_KEY_REUSED",
+                            "message": "Idempotency-Key ya usado con otro request"}), 422
+
+        def run():
+            cached = _responses.get((key, fp))
+            if cached is not None:
+                return cached, True
+            g.idempotency_key = square_key(key)
+            resp = current_app.make_response(view(*args, **kwargs))
+            entry = (resp.get_data(), resp.status_code, resp.mimetype)
+            if entry[1] < 500 and entry[1] not in _NOT_FINAL:
+                _responses.set((key, fp), entry)
+            return entry, False
+
+        (body, status, mimetype), replayed = _inflight.do((key, fp), run)
+        resp = current_app.response_class(body, status=status, mimetype=mimetype)
+        if replayed:
+            resp.headers["Idempotent-Replayed"] = "true"
+        return resp
+    return wrapper
+
+def stats():
+    return _responses.stats()
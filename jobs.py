@@ -0,0 +1,231 @@
+"""Cola local de pagos asíncronos (202 Accepted + polling) con journal SQLite.
+
+El journal (PAYMENT_JOBS_DB) guarda cada job con su idempotency_key antes de
+responder 202; si el worker muere, otro worker (o el mismo al reiniciar) re-encola
+los pendientes y Square deduplica el reintento por el mismo key. Cada job 'running'
+guarda el token de arranque del proceso dueño (pid + hora de arranque): tras un
+reinicio del contenedor los pids se repiten, el token no.
+"""
+import os, json, time, uuid, queue, sqlite3, threading
+from settings import get_settings
+import log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    status TEXT NOT NULL,            -- queued | running | done
+    owner_pid INTEGER,               -- sin uso (journals viejos); ver owner
+    owner TEXT,                      -- boot_token() del proceso que lo corre
+    http_status INTEGER,
+    result TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _process_start(pid):
+    """Hora de arranque del proceso (campo 22 de /proc/<pid>/stat); None fuera de Linux"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+_own_token = (None, None)   # (pid, token) del proceso actual
+
+def boot_token():
+    """Identidad del proceso actual que no se repite tras un reinicio aunque el pid sí"""
+    global _own_token
+    pid = os.getpid()
+    if _own_token[0] != pid:
+        _own_token = (pid, f"{pid}:{_process_start(pid) or ''}")
+    return _own_token[1]
+
+def owner_alive(token):
+    """True si el proceso del token sigue vivo (mismo pid y misma hora de arranque)"""
+    pid, _, started = (token or "").partition(":")
+    if not pid.isdigit() or not _pid_alive(int(pid)):
+        return False
+    return not started or _process_start(int(pid)) == started
+
+
+# kind -> handler(payload, idempotency_key) -> (body, http_status)
+_handlers = {}
+
+def register(kind:str, handler):
+    _handlers[kind] = handler
+
+
+class JobQueue:
+    """Jobs journaled en SQLite y ejecutados por hilos del worker actual"""
+
+    def __init__(self, path:str, workers:int=4, retention:float=7 * 86400, recover_interval:float=60):
+        self.path = path
+        self.workers = workers
+        self.retention = retention
+        self.recover_interval = recover_interval
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._started_pid = None
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(_SCHEMA)
+        if "owner" not in {c["name"] for c in conn.execute("PRAGMA table_info(payment_jobs)")}:
+            conn.execute("ALTER TABLE payment_jobs ADD COLUMN owner TEXT")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def submit(self, kind:str, payload:dict, idempotency_key:str) -> str:
+        self.start()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO payment_jobs (id, kind, payload, idempotency_key, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, kind, json.dumps(payload), idempotency_key, now, now),
+        )
+        self._queue.put(job_id)
+        return job_id
+
+    def get(self, job_id:str):
+        self.start()
+        row = self._conn().execute("SELECT * FROM payment_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "http_status": row["http_status"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def depth(self):
+        return self._queue.qsize()
+
+    # ---------------- workers ----------------
+
+    def start(self):
+        """Arranca los hilos una vez por proceso (después del fork de gunicorn; app._start_background)"""
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._token = boot_token()
+            self._recover()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"payment-job-{i}", daemon=True).start()
+            threading.Thread(target=self._recover_loop, name="payment-job-recover", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def _recover(self, queued_before=None):
+        """Re-encolar jobs 'running' de procesos muertos y 'queued' que no están en ninguna cola viva.
+        queued_before: solo los 'queued' más viejos que eso (el resto sigue en la cola de su worker)"""
+        conn = self._conn()
+        conn.execute("DELETE FROM payment_jobs WHERE status = 'done' AND updated_at < ?", (time.time() - self.retention,))
+        rows = conn.execute(
+            "SELECT id, status, owner, updated_at FROM payment_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+        ).fetchall()
+        for row in rows:
+            # Jobs 'running' de un proceso vivo (de este arranque) no son nuestros
+            if row["status"] == "running" and owner_alive(row["owner"]):
+                continue
+            if row["status"] == "queued" and queued_before is not None and row["updated_at"] > queued_before:
+                continue
+            requeued = conn.execute(
+                "UPDATE payment_jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE id = ? AND status = ? "
+                "AND owner IS ?",
+                (time.time(), row["id"], row["status"], row["owner"]),
+            ).rowcount
+            if requeued:
+                if row["status"] == "running":
+                    log.warning("payment_job_requeued", job_id=row["id"], owner=row["owner"])
+                self._queue.put(row["id"])
+
+    def _recover_loop(self):
+        # Un worker que murió con jobs 'running' no vuelve a arrancar solo: los toma otro
+        while True:
+            time.sleep(self.recover_interval)
+            try:
+                self._recover(queued_before=time.time() - self.recover_interval)
+            except Exception as e:
+                log.error("payment_job_recover_failed", exc=e)
+
+    def _claim(self, job_id):
+        conn = self._conn()
+        claimed = conn.execute(
+            "UPDATE payment_jobs SET status = 'running', owner = ?, updated_at = ? WHERE id = ? AND status = 'queued'",
+            (self._token, time.time(), job_id),
+        ).rowcount
+        if not claimed:
+            return None
+        return conn.execute("SELECT kind, payload, idempotency_key FROM payment_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def _finish(self, job_id, body, http_status):
+        self._conn().execute(
+            "UPDATE payment_jobs SET status = 'done', http_status = ?, result = ?, updated_at = ? WHERE id = ?",
+            (http_status, json.dumps(body, default=str), time.time(), job_id),
+        )
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                row = self._claim(job_id)
+                if row is None:
+                    continue
+                handler = _handlers.get(row["kind"])
+                if handler is None:
+                    self._finish(job_id, {"status": "FAILED", "code": "UNKNOWN_JOB", "message": row["kind"]}, 500)
+                    continue
+                try:
+                    body, http_status = handler(json.loads(row["payload"]), row["idempotency_key"])
+                except Exception as e:
+                    body, http_status = {"status": "FAILED", "code": "SERVER_ERROR", "message": str(e)}, 500
+                self._finish(job_id, body, http_status)
+            except Exception as e:
+                log.error("payment_job_failed", exc=e, job_id=job_id)
+            finally:
+                self._queue.task_done()
+
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+def get_jobs():
+    global _jobs
+    if _jobs is None:
+        with _jobs_lock:
+            if _jobs is None:
+                settings = get_settings()
+                _jobs = JobQueue(
+                    settings.payment_jobs_db,
+                    workers=settings.payment_job_workers,
+                    retention=settings.payment_jobs_retention,
+                )
+    return _jobs
@@ -0,0 +1,62 @@
+"""JSON de la app Flask (jsonify, request.get_json, app.json) con orjson si está instalado.
+
+Misma salida que el provider por defecto de Flask (claves ordenadas, fechas,
+UUID, Decimal, dataclasses); orjson solo es más rápido. Sin orjson, o con un
+valor que orjson no sabe serializar (ej. enteros > 64 bits), se usa el stdlib.
+"""
+import dataclasses, decimal, uuid
+from datetime import date
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson, json del stdlib
+    orjson = None
+
+def _default(o):
+    # Los mismos tipos extra que flask.json.provider._default
+    if isinstance(o, date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    backend = "orjson" if orjson is not None else "json"
+
+    def _dumpb(self, obj):
+        """bytes; None si hay que caer al stdlib"""
+        if orjson is None:
+            return None
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=_default, option=option)
+        except orjson.JSONEncodeError:
+            return None
+
+    def dumps(self, obj, **kwargs):
+        if not kwargs and (raw := self._dumpb(obj)) is not None:
+            return raw.decode()
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            # orjson.JSONDecodeError hereda de ValueError: Flask responde 400 igual
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Salida indentada (debug o compact=False): eso lo sigue haciendo el stdlib
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        if not pretty and (raw := self._dumpb(obj)) is not None:
+            return self._app.response_class(raw, mimetype=self.mimetype)
+        return super().response(*args, **kwargs)
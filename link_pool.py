@@ -0,0 +1,162 @@
+"""Pool de Payment Links pre-creados para los montos de recarga más comunes.
+
+Clave (amount, currency, note). Un hilo de fondo por worker llena cada clave hasta
+PAYMENT_LINK_POOL_SIZE y la repone cuando baja de PAYMENT_LINK_POOL_LOW_WATER;
+un hit entrega un link sin llamar a Square. Cada link se entrega una sola vez
+y se descarta a las PAYMENT_LINK_POOL_TTL horas sin usarse. Los descartados (y los
+que quedan al salir el worker, shutdown() desde gunicorn.conf.py) se borran en
+Square para que un link viejo ya no pueda cobrar.
+Montos en PAYMENT_LINK_POOL_AMOUNTS (centavos, ej. "500,1000,2000"); vacío = sin pool.
+"""
+import os, time, threading
+from collections import deque
+from metrics import LINK_POOL_SIZE, LINK_POOL_REQUESTS
+from settings import get_settings
+import log
+
+class LinkPool:
+    def __init__(self, create, keys, target=5, low_water=2, ttl=12 * 3600, refill_interval=60, delete=None):
+        self._create = create        # create(amount, currency, note) -> payment_link | {"error": ...}
+        self._delete = delete        # delete(link_id); None = no borrar en Square
+        self.keys = list(keys)
+        self.target = target
+        self.low_water = low_water
+        self.ttl = ttl
+        self.refill_interval = refill_interval
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+        self.deleted = 0
+        self._links = {key: deque() for key in self.keys}   # key -> (created_at, payment_link)
+        self._expired = []                                   # vencidos, a borrar en Square desde el hilo
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started_pid = None
+
+    def _key_label(self, key):
+        return f"{key[0]}:{key[1]}"
+
+    def _expire(self, key, now):
+        """Con self._lock tomado; los vencidos quedan en _expired (la red va fuera del lock)"""
+        links = self._links[key]
+        while links and links[0][0] + self.ttl <= now:
+            self._expired.append(links.popleft()[1])
+
+    def _discard(self, links):
+        for link in links:
+            try:
+                if self._delete(link["id"]):
+                    self.deleted += 1
+            except Exception as e:
+                log.warning("payment_link_pool_delete_failed", link_id=link["id"], exc=e)
+
+    def _discard_expired(self):
+        with self._lock:
+            expired, self._expired = self._expired, []
+        if self._delete:
+            self._discard(expired)
+
+    def shutdown(self):
+        """Borrar en Square los links sin entregar (al salir el worker)"""
+        with self._lock:
+            links = [link for links in self._links.values() for _, link in links] + self._expired
+            self._links = {key: deque() for key in self.keys}
+            self._expired = []
+        if self._delete and links:
+            self._discard(links)
+            log.info("payment_link_pool_shutdown", links=len(links), deleted=self.deleted)
+
+    def take(self, amount:int, currency:str, note:str):
+        """Link pre-creado o None (el caller crea uno en línea)"""
+        key = (amount, currency, note)
+        link = None
+        with self._lock:
+            links = self._links.get(key)
+            if links is not None:
+                self._expire(key, time.monotonic())
+                if links:
+                    link = links.popleft()[1]
+                if len(links) < self.low_water or self._expired:
+                    self._wake.set()
+            if link is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        LINK_POOL_REQUESTS.labels("hit" if link else "miss").inc()
+        if links is not None:
+            LINK_POOL_SIZE.labels(self._key_label(key)).set(len(links))
+        return link
+
+    # ---------------- relleno ----------------
+
+    def fill(self):
+        """Borrar los vencidos y completar cada clave hasta target; corta en la primera falla de Square"""
+        for key in self.keys:
+            while True:
+                with self._lock:
+                    self._expire(key, time.monotonic())
+                    missing = self.target - len(self._links[key])
+                self._discard_expired()
+                if missing <= 0:
+                    break
+                try:
+                    link = self._create(*key)
+                except Exception as e:
+                    link = {"error": str(e)}
+                if "error" in link:
+                    self.failures += 1
+                    log.warning("payment_link_pool_fill_failed", amount=key[0], currency=key[1], error=link["error"])
+                    return
+                with self._lock:
+                    self._links[key].append((time.monotonic(), link))
+                    self.created += 1
+                LINK_POOL_SIZE.labels(self._key_label(key)).set(len(self._links[key]))
+
+    def start(self):
+        """Una vez por proceso (los hilos no sobreviven al fork de gunicorn)"""
+        if not self.keys or self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        self._links = {key: deque() for key in self.keys}
+
+        def loop():
+            while True:
+                self.fill()
+                self._wake.wait(self.refill_interval)
+                self._wake.clear()
+
+        threading.Thread(target=loop, name="payment-link-pool", daemon=True).start()
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            sizes = {self._key_label(k): len(v) for k, v in self._links.items()}
+        return {
+            "sizes": sizes, "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "created": self.created, "failures": self.failures, "deleted": self.deleted,
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_link_pool(create, currency="USD", note="Recarga Cubalink23", delete=None):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                _pool = LinkPool(
+                    create, [(a, currency, note) for a in settings.payment_link_pool_amounts],
+                    target=settings.payment_link_pool_size,
+                    low_water=settings.payment_link_pool_low_water,
+                    ttl=settings.payment_link_pool_ttl,
+                    delete=delete,
+                )
+    return _pool
+
+def shutdown():
+    if _pool is not None:
+        _pool.shutdown()
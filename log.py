@@ -0,0 +1,115 @@
+"""Logging estructurado sin bloquear los handlers.
+
+    import log
+    log.info("payment_received", amount=100, customer_id=cid)
+    log.debug("card_payload", sample=0.01, data=data)   # solo 1% de las llamadas
+    log.error("payment_failed", exc=e, route="/api/payments")
+
+El hot path solo crea un LogRecord pequeño y lo encola; un hilo de fondo
+redacta campos sensibles (nonce, tokens, source_id...), serializa a JSON y escribe.
+Variables: LOG_LEVEL (INFO), LOG_QUEUE_SIZE (10000), LOG_FORMAT (json | text).
+"""
+import os, sys, json, queue, atexit, random, logging, threading
+from logging.handlers import QueueHandler, QueueListener
+from settings import get_settings
+
+_REDACT = {
+    "nonce", "source_id", "card_nonce", "token", "access_token", "authorization",
+    "api_key", "x-api-key", "password", "secret", "signature", "supabase_service_key",
+}
+_MASKED = "[redacted]"
+
+def redact(value, key=None):
+    if key is not None and key.lower() in _REDACT:
+        return _MASKED
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+class _Formatter(logging.Formatter):
+    """Corre en el hilo del listener: aquí se paga el formateo y la redacción"""
+
+    def __init__(self, fmt):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record):
+        fields = redact(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.fmt == "text":
+            extra = " ".join(f"{k}={v}" for k, v in fields.items())
+            return f"{self.formatTime(record)} {record.levelname} {record.getMessage()} {extra}".rstrip()
+        return json.dumps({
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+            "pid": record.process,
+            **fields,
+        }, default=str, ensure_ascii=False)
+
+
+class _NonBlockingHandler(QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # Sin formatear: el listener lo hace fuera del request
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _NonBlockingHandler.dropped += 1
+
+
+_logger = logging.getLogger("cubalink23.payments")
+_logger.propagate = False
+_setup_pid = None
+_setup_lock = threading.Lock()
+_listener = None
+
+def _setup():
+    """Una vez por proceso: el hilo del listener no sobrevive al fork de gunicorn"""
+    global _setup_pid, _listener
+    with _setup_lock:
+        if _setup_pid == os.getpid():
+            return
+        settings = get_settings()
+        q = queue.Queue(maxsize=settings.log_queue_size)
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(_Formatter(settings.log_format))
+        _listener = QueueListener(q, stream, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _logger.handlers = [_NonBlockingHandler(q)]
+        _logger.setLevel(settings.log_level)
+        _setup_pid = os.getpid()
+
+def flush():
+    """Vaciar la cola (scripts/tests antes de salir)"""
+    if _listener is not None and _setup_pid == os.getpid():
+        _listener.stop()
+        _listener.start()
+
+def log(level:int, event:str, sample:float=1.0, exc=None, **fields):
+    if _setup_pid != os.getpid():
+        _setup()
+    if not _logger.isEnabledFor(level):
+        return
+    if sample < 1.0 and random.random() >= sample:
+        return
+    exc_info = (type(exc), exc, exc.__traceback__) if exc is not None else None
+    # makeRecord directo: evita el recorrido del stack de findCaller
+    _logger.handle(_logger.makeRecord(_logger.name, level, "", 0, event, None, exc_info, extra={"fields": fields}))
+
+def debug(event, **fields): log(logging.DEBUG, event, **fields)
+def info(event, **fields): log(logging.INFO, event, **fields)
+def warning(event, **fields): log(logging.WARNING, event, **fields)
+def error(event, **fields): log(logging.ERROR, event, **fields)
+
+def stats():
+    return {"dropped": _NonBlockingHandler.dropped, "queued": _listener.queue.qsize() if _listener else 0}
@@ -0,0 +1,152 @@
+"""Métricas Prometheus (/metrics) + header Server-Timing.
+
+Con gunicorn, gunicorn.conf.py define PROMETHEUS_MULTIPROC_DIR antes de cargar la
+app: cada worker escribe sus valores en ese directorio y /metrics los agrega.
+"""
+import os, re, time
+from flask import g, request, has_app_context
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST,
+)
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "payments_http_request_duration_seconds", "Latencia por ruta Flask",
+    ["route", "method", "status"], buckets=_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "payments_http_requests_in_flight", "Requests en curso por ruta",
+    ["route"], multiprocess_mode="livesum",
+)
+REQUEST_ERRORS = Counter(
+    "payments_http_request_errors_total", "Respuestas 5xx por ruta", ["route", "status"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "payments_upstream_request_duration_seconds", "Latencia por operación de Square/Supabase",
+    ["upstream", "operation", "outcome"], buckets=_BUCKETS,
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "payments_upstream_requests_in_flight", "Llamadas en curso por upstream",
+    ["upstream"], multiprocess_mode="livesum",
+)
+UPSTREAM_ERRORS = Counter(
+    "payments_upstream_errors_total", "Errores (excepción o 5xx/429) por operación",
+    ["upstream", "operation"],
+)
+LINK_POOL_SIZE = Gauge(
+    "payments_link_pool_size", "Payment Links pre-creados disponibles por monto",
+    ["key"], multiprocess_mode="livesum",
+)
+LINK_POOL_REQUESTS = Counter(
+    "payments_link_pool_requests_total", "Pedidos de Payment Link: hit (del pool) o miss (creado en línea)",
+    ["result"],
+)
+WORKER_BOOT = Gauge(
+    "payments_worker_boot_seconds", "Segundos desde el fork hasta que el worker de gunicorn queda listo",
+    ["preload"], multiprocess_mode="liveall",
+)
+UPSTREAM_PROBE_SECONDS = Gauge(
+    "payments_upstream_probe_seconds", "Latencia del último probe de fondo por upstream",
+    ["upstream"], multiprocess_mode="liveall",
+)
+UPSTREAM_PROBE_UP = Gauge(
+    "payments_upstream_probe_up", "1 si el último probe de fondo respondió, 0 si falló",
+    ["upstream"], multiprocess_mode="livemin",
+)
+RATE_LIMITED = Counter(
+    "payments_rate_limited_total", "Requests rechazados con 429 por el rate limiter",
+    ["scope", "route"],
+)
+
+# IDs en paths de Square (ccof:..., CUST_..., ids de payment) → {id} para no explotar cardinalidad
+_ID_SEGMENT = re.compile(r"/(?:ccof:[^/]+|[A-Za-z0-9_:-]*\d[A-Za-z0-9_:-]{7,})(?=/|$)")
+
+def operation_name(method:str, path:str):
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+def _outcome(result):
+    status = getattr(result, "status_code", 200)
+    return "error" if status >= 500 or status == 429 else "ok"
+
+def _observed(upstream, operation, outcome, elapsed):
+    UPSTREAM_IN_FLIGHT.labels(upstream).dec()
+    UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(elapsed)
+    if outcome == "error":
+        UPSTREAM_ERRORS.labels(upstream, operation).inc()
+    # Solo en el hilo del request (no en pools de batch/jobs)
+    if has_app_context():
+        timings = g.setdefault("upstream_timings", {})
+        timings[upstream] = timings.get(upstream, 0.0) + elapsed
+
+def observe_upstream(upstream:str, operation:str, fn, *args, **kwargs):
+    """Ejecutar la llamada al upstream midiendo latencia, en vuelo y errores"""
+    UPSTREAM_IN_FLIGHT.labels(upstream).inc()
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = fn(*args, **kwargs)
+        outcome = _outcome(result)
+        return result
+    finally:
+        _observed(upstream, operation, outcome, time.perf_counter() - start)
+
+async def observe_upstream_async(upstream:str, operation:str, fn, *args, **kwargs):
+    """observe_upstream para corrutinas (square_client_async)"""
+    UPSTREAM_IN_FLIGHT.labels(upstream).inc()
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await fn(*args, **kwargs)
+        outcome = _outcome(result)
+        return result
+    finally:
+        _observed(upstream, operation, outcome, time.perf_counter() - start)
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+def _before():
+    g.request_started = time.perf_counter()
+    g.metrics_route = _route()
+    REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+def _teardown(exc):
+    route = g.pop("metrics_route", None)
+    if route is not None:
+        REQUESTS_IN_FLIGHT.labels(route).dec()
+
+def _after(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    total = time.perf_counter() - started
+    route = g.metrics_route
+    status = str(response.status_code)
+    REQUEST_LATENCY.labels(route, request.method, status).observe(total)
+    if response.status_code >= 500:
+        REQUEST_ERRORS.labels(route, status).inc()
+
+    timings = g.get("upstream_timings", {})
+    parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in timings.items()]
+    parts.append(f"app;dur={max(total - sum(timings.values()), 0) * 1000:.1f}")
+    parts.append(f"total;dur={total * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(parts)
+    return response
+
+def _registry():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def init_app(app):
+    app.before_request(_before)
+    app.after_request(_after)
+    app.teardown_request(_teardown)
+
+    @app.get("/metrics")
+    def metrics():
+        return generate_latest(_registry()), 200, {"Content-Type": CONTENT_TYPE_LATEST}
@@ -0,0 +1,268 @@
+"""Outbox local para escrituras a Supabase que no deben frenar el request.
+
+enqueue() solo inserta una fila en SQLite (OUTBOX_DB, WAL) y vuelve; un hilo
+(uno solo entre todos los workers: flock sobre OUTBOX_DB.lock) las reenvía en
+lotes. Orden por usuario: si una escritura de un usuario falla, las siguientes
+del mismo usuario esperan a que esa se reintente (backoff exponencial); los
+demás usuarios siguen. Las filas sobreviven a un reinicio del worker.
+
+Cada kind registra un handler(payloads) que escribe una lista de payloads en una
+sola llamada y lanza una excepción si falla (el lote completo se reintenta:
+los handlers deben ser idempotentes, ej. upsert). Una fila que Supabase rechaza
+por sus datos (is_client_error), o que falla OUTBOX_MAX_ATTEMPTS veces, pasa a
+outbox_dead y deja de bloquear a su usuario.
+"""
+import os, json, time, fcntl, sqlite3, threading
+from settings import get_settings
+from supabase_client import is_client_error
+from breaker import UpstreamUnavailable
+import log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    ref TEXT,                        -- ej. square_card_id, para cancel()
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_ref ON outbox (kind, ref);
+CREATE INDEX IF NOT EXISTS outbox_next ON outbox (next_attempt_at, id);
+CREATE INDEX IF NOT EXISTS outbox_user ON outbox (user_id, next_attempt_at);
+CREATE TABLE IF NOT EXISTS outbox_dead (
+    id INTEGER PRIMARY KEY,          -- mismo id que tenía en outbox
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    ref TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    dead_at REAL NOT NULL
+);
+"""
+
+# kind -> handler(payloads)
+_handlers = {}
+
+def register(kind:str, handler):
+    _handlers[kind] = handler
+
+
+def _runs(rows):
+    """Filas consecutivas del mismo kind → una llamada por tramo (respeta el orden global).
+    Una fila que ya falló va sola: una fila inválida no vuelve a arrastrar al lote."""
+    run = []
+    for row in rows:
+        if run and (run[-1]["kind"] != row["kind"] or row["attempts"] or run[-1]["attempts"]):
+            yield run
+            run = []
+        run.append(row)
+    if run:
+        yield run
+
+
+class Outbox:
+    def __init__(self, path:str, batch:int=100, poll_interval:float=0.2, max_backoff:float=60, stats_interval:float=1,
+                 max_attempts:int=10):
+        self.path = path
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.stats_interval = stats_interval
+        self.max_attempts = max_attempts
+        self.stats = {"enqueued": 0, "written": 0, "batches": 0, "failures": 0, "dead_letters": 0, "last_error": None}
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._started_pid = None
+        self._lock_file = None
+        self._lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+        self._counts = self._count()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def enqueue(self, kind:str, user_id:str, payload:dict, ref:str=None):
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO outbox (kind, user_id, ref, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, str(user_id), ref, json.dumps(payload), now, now),
+        )
+        self.stats["enqueued"] += 1
+        self._wake.set()
+
+    def cancel(self, kind:str, ref:str):
+        """Descartar escrituras pendientes (ej. tarjeta eliminada antes de llegar a Supabase)"""
+        return self._conn().execute("DELETE FROM outbox WHERE kind = ? AND ref = ?", (kind, ref)).rowcount
+
+    def pending(self, kind:str, ref:str):
+        row = self._conn().execute("SELECT payload FROM outbox WHERE kind = ? AND ref = ? ORDER BY id DESC", (kind, ref)).fetchone()
+        return json.loads(row["payload"]) if row else None
+
+    # ---------------- drenado ----------------
+
+    def _next_batch(self, now):
+        """Las primeras filas listas por id; un usuario con una fila en backoff queda bloqueado detrás de ella.
+        Las filas en backoff no ocupan lugar en el lote: no frenan a los demás usuarios"""
+        return self._conn().execute(
+            "SELECT * FROM outbox WHERE next_attempt_at <= ? AND user_id NOT IN "
+            "(SELECT user_id FROM outbox WHERE next_attempt_at > ?) ORDER BY id LIMIT ?",
+            (now, now, self.batch),
+        ).fetchall()
+
+    def _dead_letter(self, row, error):
+        """Sacar la fila del outbox (queda en outbox_dead para revisarla a mano)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO outbox_dead (id, kind, user_id, ref, payload, attempts, last_error, created_at, dead_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (row["id"], row["kind"], row["user_id"], row["ref"], row["payload"], row["attempts"] + 1,
+                 str(error)[:500], row["created_at"], time.time()),
+            )
+            conn.execute("DELETE FROM outbox WHERE id = ?", (row["id"],))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.stats["dead_letters"] += 1
+        log.error("outbox_dead_letter", exc=error, kind=row["kind"], user_id=row["user_id"], outbox_id=row["id"])
+
+    def drain(self):
+        """Un lote; devuelve cuántas filas se escribieron"""
+        rows = self._next_batch(time.time())
+        conn = self._conn()
+        failed, written = set(), 0
+        for run in _runs(rows):
+            run = [r for r in run if r["user_id"] not in failed]
+            if not run:
+                continue
+            handler = _handlers.get(run[0]["kind"])
+            try:
+                if handler is None:
+                    raise RuntimeError(f"kind sin handler: {run[0]['kind']}")
+                handler([json.loads(r["payload"]) for r in run])
+            except Exception as e:
+                self.stats["failures"] += 1
+                self.stats["last_error"] = str(e)
+                log.error("outbox_write_failed", exc=e, kind=run[0]["kind"], rows=len(run))
+                now = time.time()
+                for r in run:
+                    # Sola en su tramo (ya falló antes o quedó aislada): la culpa es de esta fila.
+                    # Con el circuito abierto no es culpa de la fila: sigue esperando
+                    if len(run) == 1 and not isinstance(e, UpstreamUnavailable) and (
+                            is_client_error(e) or r["attempts"] + 1 >= self.max_attempts):
+                        self._dead_letter(r, e)
+                        continue
+                    failed.add(r["user_id"])
+                    conn.execute(
+                        "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (now + min(self.max_backoff, 2 ** r["attempts"]), str(e)[:500], r["id"]),
+                    )
+                continue
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(r["id"],) for r in run])
+            written += len(run)
+            self.stats["batches"] += 1
+        if written:
+            self.stats["written"] += written
+            self.stats["last_error"] = None
+        return written
+
+    def start(self, ready=lambda: True):
+        """Una vez por proceso; el worker que toma el flock drena, los demás reintentan tomarlo"""
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._wake = threading.Event()
+
+            def take_lock():
+                lock_file = open(self.path + ".lock", "w")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return False
+                self._lock_file = lock_file  # mantener abierto: el lock vive con el proceso
+                return True
+
+            def loop():
+                # Si el worker que drena muere, otro toma el lock
+                while not take_lock():
+                    time.sleep(5)
+                log.info("outbox_drainer_started", pid=os.getpid())
+                while True:
+                    try:
+                        # sin Supabase (o reconectando): esperar
+                        if ready() and self.drain():
+                            continue
+                    except Exception as e:
+                        self.stats["last_error"] = str(e)
+                        log.error("outbox_drain_failed", exc=e)
+                    # enqueue() de este worker despierta al hilo; los de otros workers se ven al sondear
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+
+            def count_loop():
+                while True:
+                    time.sleep(self.stats_interval)
+                    try:
+                        self._counts = self._count()
+                    except Exception as e:
+                        log.warning("outbox_count_failed", exc=e)
+
+            threading.Thread(target=loop, name="supabase-outbox", daemon=True).start()
+            # En todos los workers: /health lee la última cuenta, no recorre la tabla
+            threading.Thread(target=count_loop, name="supabase-outbox-stats", daemon=True).start()
+
+    def _count(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS depth, MIN(created_at) AS oldest, "
+            "SUM(attempts > 0) AS retrying, MAX(attempts) AS max_attempts FROM outbox"
+        ).fetchone()
+        dead = self._conn().execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+        return {"depth": row["depth"], "oldest": row["oldest"], "dead": dead,
+                "retrying": row["retrying"] or 0, "max_attempts": row["max_attempts"] or 0}
+
+    def snapshot(self):
+        """Contadores en memoria; depth/retrying se recuentan cada stats_interval (hilo de start())"""
+        counts = self._counts
+        return {
+            **self.stats, "depth": counts["depth"],
+            "lag_seconds": round(time.time() - counts["oldest"], 3) if counts["oldest"] else 0.0,
+            "retrying": counts["retrying"], "max_attempts": counts["max_attempts"], "dead": counts["dead"],
+            "draining": self._lock_file is not None,
+        }
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                settings = get_settings()
+                _outbox = Outbox(
+                    settings.outbox_db,
+                    batch=settings.outbox_batch,
+                    poll_interval=settings.outbox_poll_interval,
+                    max_attempts=settings.outbox_max_attempts,
+                )
+    return _outbox
@@ -0,0 +1,119 @@
+"""Probes de fondo contra Square y Supabase; /health y /health/deep leen el último resultado.
+
+Un hilo por upstream y por worker llama al check cada HEALTH_PROBE_INTERVAL
+segundos (los checks de balanceador no generan tráfico hacia Square/Supabase).
+Estado por upstream:
+  ok         último probe respondió en menos de HEALTH_PROBE_SLOW_MS
+  degraded   respondió lento, o falló menos de HEALTH_PROBE_DOWN_AFTER veces seguidas
+  down       falló HEALTH_PROBE_DOWN_AFTER veces seguidas
+  unknown    sin probes todavía (o el resultado quedó viejo)
+  disabled   upstream sin configurar, o probes desactivados (HEALTH_PROBE_INTERVAL=0)
+El estado general ignora los upstreams disabled; si no queda ninguno, es disabled.
+Los probes no pasan por el circuit breaker: miden aunque el circuito esté abierto.
+"""
+import os, time, threading
+from metrics import UPSTREAM_PROBE_SECONDS, UPSTREAM_PROBE_UP
+from settings import get_settings
+import log
+
+OK, DEGRADED, DOWN, UNKNOWN, DISABLED = "ok", "degraded", "down", "unknown", "disabled"
+
+class Probe:
+    def __init__(self, name:str, check, enabled=lambda: True):
+        self.name = name
+        self.check = check          # check() lanza una excepción si el upstream no responde
+        self.enabled = enabled
+        self.result = {
+            "latency_ms": None, "last_success": None, "last_failure": None,
+            "last_error": None, "consecutive_failures": 0, "checked_at": None,
+        }
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            self.check()
+        except Exception as e:
+            elapsed = time.perf_counter() - started
+            failures = self.result["consecutive_failures"] + 1
+            self.result = {**self.result, "latency_ms": round(elapsed * 1000, 1), "last_failure": time.time(),
+                           "last_error": str(e)[:300], "consecutive_failures": failures, "checked_at": time.time()}
+            UPSTREAM_PROBE_UP.labels(self.name).set(0)
+            if failures == 1:
+                log.warning("upstream_probe_failed", upstream=self.name, exc=e)
+            return
+        elapsed = time.perf_counter() - started
+        # Un solo reemplazo del dict: los lectores nunca ven un resultado a medias
+        self.result = {**self.result, "latency_ms": round(elapsed * 1000, 1), "last_success": time.time(),
+                       "last_error": None, "consecutive_failures": 0, "checked_at": time.time()}
+        UPSTREAM_PROBE_SECONDS.labels(self.name).set(elapsed)
+        UPSTREAM_PROBE_UP.labels(self.name).set(1)
+
+
+class Prober:
+    def __init__(self, interval:float=15, slow_ms:float=1000, down_after:int=3):
+        self.interval = interval
+        self.slow_ms = slow_ms
+        self.down_after = down_after
+        self.probes = {}
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def register(self, name:str, check, enabled=lambda: True):
+        self.probes[name] = Probe(name, check, enabled)
+
+    def start(self):
+        """Una vez por proceso (después del fork de gunicorn); HEALTH_PROBE_INTERVAL=0 lo desactiva"""
+        if self._started_pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for probe in self.probes.values():
+                threading.Thread(target=self._loop, args=(probe,), name=f"probe-{probe.name}", daemon=True).start()
+
+    def _loop(self, probe):
+        while True:
+            if probe.enabled():
+                probe.run()
+            time.sleep(self.interval)
+
+    def status(self, probe):
+        r = probe.result
+        if self.interval <= 0 or not probe.enabled():
+            return DISABLED
+        # Hilo colgado en un check (ej. timeout largo): el último resultado ya no vale
+        if r["checked_at"] is None or time.time() - r["checked_at"] > 3 * self.interval + 30:
+            return UNKNOWN
+        if r["consecutive_failures"] >= self.down_after:
+            return DOWN
+        if r["consecutive_failures"] or r["latency_ms"] > self.slow_ms:
+            return DEGRADED
+        return OK
+
+    def snapshot(self):
+        """Solo lee el último resultado de cada probe: O(upstreams), sin red"""
+        upstreams = {name: {"status": self.status(p), **p.result} for name, p in self.probes.items()}
+        statuses = {u["status"] for u in upstreams.values()} - {DISABLED}
+        if not statuses:
+            overall = DISABLED
+        else:
+            overall = DOWN if DOWN in statuses else DEGRADED if statuses & {DEGRADED, UNKNOWN} else OK
+        return {"status": overall, "interval": self.interval, "upstreams": upstreams}
+
+
+_prober = None
+_prober_lock = threading.Lock()
+
+def get_prober():
+    global _prober
+    if _prober is None:
+        with _prober_lock:
+            if _prober is None:
+                settings = get_settings()
+                _prober = Prober(
+                    interval=settings.health_probe_interval,
+                    slow_ms=settings.health_probe_slow_ms,
+                    down_after=settings.health_probe_down_after,
+                )
+    return _prober
@@ -0,0 +1,153 @@
+"""Rate limiting delante de las rutas que llaman a Square.
+
+- Token bucket por usuario (user_id / customer_id del body) y por API key
+  (X-Api-Key; sin header, por IP): RATE_LIMIT_USER="10/60" = 10 por minuto, ráfaga 10.
+- Tope global de llamadas a Square en curso (SQUARE_MAX_IN_FLIGHT) entre todos los workers:
+  lo toma square_client.square_request en cada llamada (rutas, jobs, batch, pool de links,
+  card_sync, export), esperando hasta SQUARE_IN_FLIGHT_WAIT segundos por un cupo.
+
+El estado vive en el store SQLite compartido (get_default_store()): todos los
+workers ven los mismos buckets y el mismo tope.
+Rechazo → 429 RATE_LIMITED + Retry-After.
+"""
+import math, time, hashlib
+from functools import wraps
+from flask import request, jsonify, has_request_context
+from shared_store import get_default_store
+from settings import get_settings
+from breaker import UpstreamUnavailable
+from metrics import RATE_LIMITED
+from jobs import boot_token, owner_alive
+import log
+
+class InFlightLimited(UpstreamUnavailable):
+    """SQUARE_MAX_IN_FLIGHT alcanzado: no se llamó a Square"""
+    code = "RATE_LIMITED"
+    status_code = 429
+
+    def __init__(self, retry_after:float=1.0):
+        self.upstream = "square"
+        self.retry_after = retry_after
+        Exception.__init__(self, "Demasiadas llamadas a Square en curso, reintentar más tarde")
+
+
+class RateLimiter:
+    def __init__(self, user_rate, key_rate, max_in_flight:int=0, in_flight_wait:float=2):
+        self.user_rate = user_rate
+        self.key_rate = key_rate
+        self.max_in_flight = max_in_flight
+        self.in_flight_wait = in_flight_wait
+        self.rejected = {"user": 0, "api_key": 0, "in_flight": 0}
+        # Último total en curso que vio este worker al tomar/soltar un cupo (/health no toca el store)
+        self._in_flight = 0
+
+    def _store(self):
+        return get_default_store()
+
+    # ---------------- token bucket ----------------
+
+    def take(self, bucket:str, rate):
+        """Consumir un token; devuelve 0 si hay, o los segundos hasta el próximo"""
+        capacity, per_second = rate
+        now = time.time()
+
+        def refill(state):
+            tokens, updated = (state or (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * per_second)
+            if tokens >= 1:
+                return (tokens - 1, now), 0.0
+            return (tokens, now), (1 - tokens) / per_second
+
+        # El bucket lleno equivale a no existir: TTL = tiempo de recarga completa
+        return self._store().update(f"rl:{bucket}", refill, ttl=capacity / per_second + 1)
+
+    # ---------------- llamadas a Square en curso ----------------
+
+    def acquire(self):
+        if not self.max_in_flight:
+            return True
+        pid = boot_token()
+
+        def inc(state):
+            # {token de arranque: en curso}; los workers muertos (o de antes de un reinicio) no cuentan
+            state = {p: n for p, n in (state or {}).items() if n > 0 and (p == pid or owner_alive(p))}
+            self._in_flight = sum(state.values())
+            if self._in_flight >= self.max_in_flight:
+                return state, False
+            state[pid] = state.get(pid, 0) + 1
+            self._in_flight += 1
+            return state, True
+
+        return self._store().update("rl:square_in_flight", inc)
+
+    def acquire_wait(self):
+        """acquire() reintentando hasta in_flight_wait segundos; InFlightLimited si no hubo cupo"""
+        deadline = time.monotonic() + self.in_flight_wait
+        while not self.acquire():
+            if time.monotonic() >= deadline:
+                self.reject_in_flight()
+            time.sleep(0.05)
+
+    def reject_in_flight(self):
+        self.rejected["in_flight"] += 1
+        RATE_LIMITED.labels("in_flight", request.url_rule.rule if has_request_context() and request.url_rule else "background").inc()
+        log.warning("rate_limited", scope="in_flight", route=request.path if has_request_context() else None)
+        raise InFlightLimited()
+
+    def release(self):
+        if not self.max_in_flight:
+            return
+        pid = boot_token()
+
+        def dec(state):
+            state = dict(state or {})
+            state[pid] = max(state.get(pid, 0) - 1, 0)
+            self._in_flight = sum(state.values())
+            return state, None
+
+        self._store().update("rl:square_in_flight", dec)
+
+    def stats(self):
+        return {
+            "user": self.user_rate and {"capacity": self.user_rate[0], "per_second": round(self.user_rate[1], 4)},
+            "api_key": self.key_rate and {"capacity": self.key_rate[0], "per_second": round(self.key_rate[1], 4)},
+            "max_in_flight": self.max_in_flight, "in_flight": self._in_flight if self.max_in_flight else None,
+            "rejected": dict(self.rejected),
+        }
+
+    # ---------------- decorador ----------------
+
+    def _reject(self, scope, retry_after):
+        self.rejected[scope] += 1
+        RATE_LIMITED.labels(scope, request.url_rule.rule if request.url_rule else "unmatched").inc()
+        log.warning("rate_limited", scope=scope, route=request.path, retry_after=round(retry_after, 2))
+        return jsonify({
+            "status": "FAILED", "code": "RATE_LIMITED", "scope": scope,
+            "message": "Demasiadas solicitudes, reintentar más tarde",
+        }), 429, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+    def limit(self, f):
+        """Buckets por API key y usuario (el tope de Square en curso va en square_request)"""
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            data = request.get_json(force=True, silent=True)
+            data = data if isinstance(data, dict) else {}
+            api_key = request.headers.get("X-Api-Key")
+            # La API key no se guarda en claro en el store. Sin key, por IP del cliente:
+            # remote_addr ya viene de X-Forwarded-For (ProxyFix en app.py, TRUSTED_PROXIES)
+            client = hashlib.sha256(api_key.encode()).hexdigest()[:24] if api_key else f"ip:{request.remote_addr}"
+            user = data.get("user_id") or data.get("customer_id")
+            if self.key_rate and (wait := self.take(f"key:{client}", self.key_rate)):
+                return self._reject("api_key", wait)
+            if self.user_rate and user and (wait := self.take(f"user:{user}", self.user_rate)):
+                return self._reject("user", wait)
+            return f(*args, **kwargs)
+        return wrapper
+
+
+limiter = RateLimiter(
+    user_rate=get_settings().rate_limit_user,
+    key_rate=get_settings().rate_limit_api_key,
+    max_in_flight=get_settings().square_max_in_flight,
+    in_flight_wait=get_settings().square_in_flight_wait,
+)
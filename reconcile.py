@@ -0,0 +1,230 @@
+"""Export de pagos de Square + conciliación contra payment_cards / user_square.
+
+    python reconcile.py export --begin 2026-01-01T00:00:00Z --format csv > pagos.csv
+    python reconcile.py run                  # pasada incremental desde el cursor guardado
+    python reconcile.py mismatches --limit 50
+
+El export es un generador página a página (memoria constante). La conciliación
+guarda en RECONCILE_DB (reconcile.db) el último created_at procesado: cada pasada
+solo lee pagos nuevos. Las diferencias encontradas quedan en reconcile_mismatches.
+"""
+import os, io, csv, json, time, sqlite3, argparse, threading
+from itertools import islice
+from square_client import list_payments
+from settings import get_settings
+import log
+
+EXPORT_FIELDS = (
+    "id", "created_at", "status", "amount", "currency", "customer_id", "card_id",
+    "card_brand", "last4", "entry_method", "note", "receipt_url",
+)
+
+def flatten(payment:dict) -> dict:
+    money = payment.get("amount_money") or {}
+    details = payment.get("card_details") or {}
+    card = details.get("card") or {}
+    return {
+        "id": payment.get("id"),
+        "created_at": payment.get("created_at"),
+        "status": payment.get("status"),
+        "amount": money.get("amount"),
+        "currency": money.get("currency"),
+        "customer_id": payment.get("customer_id"),
+        "card_id": card.get("id"),
+        "card_brand": card.get("card_brand"),
+        "last4": card.get("last_4"),
+        "entry_method": details.get("entry_method"),
+        "note": payment.get("note"),
+        "receipt_url": payment.get("receipt_url"),
+    }
+
+def export_ndjson(payments):
+    for p in payments:
+        yield json.dumps(flatten(p), ensure_ascii=False) + "\n"
+
+def export_csv(payments):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    # El encabezado sale aunque el rango no tenga pagos
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    for p in payments:
+        writer.writerow(flatten(p))
+        # Un solo buffer reutilizado: se vacía después de cada fila
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+# ====================== CONCILIACIÓN ======================
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+def check_page(payments, client, run):
+    """Diferencias de una página de pagos. Dos queries por página (in_), no por pago.
+    client() devuelve el cliente Supabase y run(query) ejecuta la query
+    (en la app: get_supabase y _sb, a través del circuit breaker)."""
+    card_ids = {c for p in payments if (c := flatten(p)["card_id"]) and c.startswith("ccof:")}
+    customer_ids = {p["customer_id"] for p in payments if p.get("customer_id")}
+    cards, owners = {}, {}
+    if card_ids:
+        rows = run(client().table("payment_cards").select("user_id, square_card_id, square_customer_id")
+                   .in_("square_card_id", sorted(card_ids))).data
+        cards = {r["square_card_id"]: r for r in rows}
+    if customer_ids:
+        rows = run(client().table("user_square").select("user_id, square_customer_id")
+                   .in_("square_customer_id", sorted(customer_ids))).data
+        owners = {r["square_customer_id"]: r["user_id"] for r in rows}
+
+    for p in payments:
+        row = flatten(p)
+        customer_id, card_id = row["customer_id"], row["card_id"]
+        if customer_id and customer_id not in owners:
+            yield row, "UNKNOWN_CUSTOMER", f"customer {customer_id} no está en user_square"
+        if not (card_id and card_id.startswith("ccof:")):
+            continue
+        card = cards.get(card_id)
+        if card is None:
+            yield row, "UNKNOWN_CARD", f"tarjeta {card_id} no está en payment_cards"
+            continue
+        if customer_id and card["square_customer_id"] != customer_id:
+            yield row, "CARD_CUSTOMER_MISMATCH", f"tarjeta de {card['square_customer_id']}, cobrada a {customer_id}"
+        elif customer_id in owners and owners[customer_id] != card["user_id"]:
+            yield row, "CARD_USER_MISMATCH", f"tarjeta de user {card['user_id']}, customer de user {owners[customer_id]}"
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reconcile_cursor (
+    name TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,        -- último created_at procesado
+    ids TEXT NOT NULL,               -- pagos ya vistos con ese mismo created_at
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reconcile_mismatches (
+    payment_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    detail TEXT NOT NULL,
+    payment TEXT NOT NULL,
+    payment_created_at TEXT,
+    found_at REAL NOT NULL,
+    PRIMARY KEY (payment_id, kind)
+)
+"""
+
+class Reconciler:
+    """Estado de la conciliación en SQLite: cursor + diferencias encontradas"""
+
+    def __init__(self, path:str, page_size:int=100):
+        self.path = path
+        self.page_size = page_size
+        self._local = threading.local()
+        self._run_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def cursor(self, name="square_payments"):
+        row = self._conn().execute("SELECT created_at, ids FROM reconcile_cursor WHERE name = ?", (name,)).fetchone()
+        return (row["created_at"], set(json.loads(row["ids"]))) if row else (None, set())
+
+    def _save_cursor(self, name, created_at, ids):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO reconcile_cursor (name, created_at, ids, updated_at) VALUES (?, ?, ?, ?)",
+            (name, created_at, json.dumps(sorted(ids)), time.time()),
+        )
+
+    def run(self, client, run, end_time=None, name="square_payments"):
+        """Pasada incremental: pagos desde el cursor (ASC), diferencias a la tabla, cursor tras cada página"""
+        with self._run_lock:
+            since, seen = self.cursor(name)
+            payments = (p for p in list_payments(begin_time=since, end_time=end_time, sort_order="ASC", limit=self.page_size)
+                        if p["id"] not in seen)  # begin_time es inclusivo
+            scanned = found = 0
+            conn = self._conn()
+            for page in _chunks(payments, self.page_size):
+                now = time.time()
+                for row, kind, detail in check_page(page, client, run):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO reconcile_mismatches "
+                        "(payment_id, kind, detail, payment, payment_created_at, found_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (row["id"], kind, detail, json.dumps(row), row["created_at"], now),
+                    )
+                    found += 1
+                for p in page:
+                    if p["created_at"] != since:
+                        since, seen = p["created_at"], set()
+                    seen.add(p["id"])
+                self._save_cursor(name, since, seen)
+                scanned += len(page)
+            log.info("reconcile_pass", scanned=scanned, mismatches=found, cursor=since)
+            return {"scanned": scanned, "mismatches": found, "cursor": since}
+
+    def mismatches(self, limit=100, kind=None):
+        sql = "SELECT * FROM reconcile_mismatches"
+        args = ()
+        if kind:
+            sql, args = sql + " WHERE kind = ?", (kind,)
+        rows = self._conn().execute(sql + " ORDER BY found_at DESC, payment_created_at DESC LIMIT ?", (*args, limit)).fetchall()
+        return [{
+            "payment_id": r["payment_id"], "kind": r["kind"], "detail": r["detail"],
+            "payment": json.loads(r["payment"]), "found_at": r["found_at"],
+        } for r in rows]
+
+
+_reconciler = None
+_reconciler_lock = threading.Lock()
+
+def get_reconciler():
+    global _reconciler
+    if _reconciler is None:
+        with _reconciler_lock:
+            if _reconciler is None:
+                settings = get_settings()
+                _reconciler = Reconciler(
+                    settings.reconcile_db,
+                    page_size=settings.reconcile_page_size,
+                )
+    return _reconciler
+
+# ====================== CLI ======================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export", help="pagos de Square a stdout")
+    exp.add_argument("--begin", help="RFC 3339, inclusivo")
+    exp.add_argument("--end", help="RFC 3339, exclusivo")
+    exp.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    exp.add_argument("--sort", choices=("ASC", "DESC"), default="ASC")
+    rec = sub.add_parser("run", help="conciliación incremental desde el cursor guardado")
+    rec.add_argument("--end", help="RFC 3339, exclusivo")
+    mm = sub.add_parser("mismatches", help="últimas diferencias encontradas")
+    mm.add_argument("--limit", type=int, default=100)
+    mm.add_argument("--kind")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        payments = list_payments(begin_time=args.begin, end_time=args.end, sort_order=args.sort)
+        for chunk in (export_csv if args.format == "csv" else export_ndjson)(payments):
+            print(chunk, end="")
+    elif args.command == "run":
+        from app import get_supabase, _sb  # mismo cliente y breaker que la app
+        print(json.dumps(get_reconciler().run(get_supabase, _sb, end_time=args.end)))
+    else:
+        for m in get_reconciler().mismatches(args.limit, args.kind):
+            print(json.dumps(m, ensure_ascii=False))
+    log.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Configuración leída y validada una sola vez (get_settings()).
+
+Valores inmutables: en el hot path (cada llamada a Square) no se relee el entorno.
+Un valor inválido (ej. SQUARE_READ_TIMEOUT=abc, LOG_LEVEL=verbose) falla al arrancar
+con SettingsError, no en el primer pago. Todos los módulos leen su configuración de
+aquí (gunicorn.conf.py lee la suya antes de cargar la app).
+"""
+import os, threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+class SettingsError(ValueError):
+    """Variable de entorno con valor inválido"""
+
+_SQUARE_BASE_URLS = {
+    "production": "https://connect.squareup.com",
+    "sandbox": "https://connect.squareupsandbox.com",
+}
+
+def _number(env, name, default, cast=float, minimum=0):
+    raw = env.get(name, default)
+    try:
+        value = cast(raw)
+    except (TypeError, ValueError):
+        raise SettingsError(f"{name} debe ser un número (recibido {raw!r})") from None
+    if value < minimum:
+        raise SettingsError(f"{name} debe ser >= {minimum} (recibido {raw!r})")
+    return value
+
+def _rate(env, name, default):
+    """"10/60" → (capacidad 10, 10/60 tokens por segundo); vacío o "0" = sin límite"""
+    spec = env.get(name, default)
+    if not spec or spec.strip() == "0":
+        return None
+    count, _, seconds = spec.partition("/")
+    try:
+        count, seconds = float(count), float(seconds or 1)
+    except ValueError:
+        raise SettingsError(f"{name} debe ser cantidad/segundos, ej. 10/60 (recibido {spec!r})") from None
+    if count < 1 or seconds <= 0:
+        raise SettingsError(f"{name} debe ser cantidad/segundos, ej. 10/60 (recibido {spec!r})")
+    return count, count / seconds
+
+def _amounts(env, name):
+    raw = env.get(name, "")
+    try:
+        amounts = tuple(int(a) for a in raw.split(",") if a.strip())
+    except ValueError:
+        raise SettingsError(f"{name} debe ser una lista de centavos, ej. 500,1000 (recibido {raw!r})") from None
+    if any(a < 1 for a in amounts):
+        raise SettingsError(f"{name} debe ser una lista de centavos, ej. 500,1000 (recibido {raw!r})")
+    return amounts
+
+def _breaker(env, upstream):
+    prefix = f"{upstream.upper()}_BREAKER_"
+    return {
+        "window": _number(env, prefix + "WINDOW", "50", int, minimum=1),
+        "min_calls": _number(env, prefix + "MIN_CALLS", "20", int, minimum=1),
+        "error_rate": _number(env, prefix + "ERROR_RATE", "0.5"),
+        "slow_rate": _number(env, prefix + "SLOW_RATE", "0.5"),
+        "slow_call": _number(env, prefix + "SLOW_CALL", "5"),
+        "open_seconds": _number(env, prefix + "OPEN_SECONDS", "30"),
+    }
+
+_LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+
+@dataclass(frozen=True)
+class Settings:
+    square_env: str
+    square_base_url: str
+    square_access_token: str = field(repr=False)
+    square_location_id: str
+    square_pool_size: int
+    square_connect_retries: int
+    square_connect_timeout: float
+    square_read_timeout: float
+    square_min_read_timeout: float
+    square_timeout_p99_factor: float
+    square_webhook_signature_key: Optional[str] = field(repr=False)
+    square_webhook_url: Optional[str]
+    supabase_url: Optional[str]
+    supabase_key: Optional[str] = field(repr=False)
+    supabase_reconnect_seconds: float
+    internal_api_key: Optional[str] = field(repr=False)
+    trusted_proxies: int
+    # Logging (log.py)
+    log_level: str
+    log_format: str
+    log_queue_size: int
+    # Circuit breakers (breaker.py): upstream -> kwargs de CircuitBreaker
+    breakers: dict
+    # Rate limiting (ratelimit.py)
+    rate_limit_user: Optional[tuple]
+    rate_limit_api_key: Optional[tuple]
+    square_max_in_flight: int
+    square_in_flight_wait: float
+    # Stores SQLite locales
+    shared_store_path: Optional[str]
+    shared_store_default_path: str
+    outbox_db: str
+    payment_jobs_db: str
+    card_sync_db: str
+    reconcile_db: str
+    # Cachés en memoria (app.py, idempotency.py)
+    customer_cache_size: int
+    customer_cache_ttl: float
+    cards_cache_size: int
+    cards_cache_ttl: float
+    card_index_size: int
+    card_index_ttl: float
+    idempotency_cache_size: int
+    idempotency_ttl: float
+    # Listado de tarjetas y lotes (app.py)
+    cards_page_size: int
+    cards_page_max: int
+    batch_max_items: int
+    batch_sync_max_items: int
+    batch_max_concurrency: int
+    batch_pool_size: int
+    sdk_card_max_age: int
+    # Escrituras diferidas a Supabase (outbox.py); tablas que pasan por el outbox
+    supabase_outbox: frozenset
+    outbox_batch: int
+    outbox_poll_interval: float
+    outbox_max_attempts: int
+    # Jobs 202 (jobs.py)
+    payment_job_workers: int
+    payment_jobs_retention: float
+    # Webhooks (webhooks.py)
+    square_webhook_batch: int
+    square_webhook_flush_interval: float
+    square_webhook_queue_size: int
+    square_webhook_max_attempts: int
+    # Pool de payment links (link_pool.py)
+    payment_link_pool_amounts: tuple
+    payment_link_pool_size: int
+    payment_link_pool_low_water: int
+    payment_link_pool_ttl: float
+    # Sync de tarjetas y conciliación (card_sync.py, reconcile.py)
+    card_sync_interval: float
+    card_sync_pages: int
+    card_sync_page_size: int
+    card_sync_disable_orphans_after: float
+    reconcile_page_size: int
+    # Probes de salud (probes.py)
+    health_probe_interval: float
+    health_probe_slow_ms: float
+    health_probe_down_after: int
+    health_probe_timeout: float
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = os.environ if env is None else env
+        square_env = env.get("SQUARE_ENV", "sandbox").lower()
+        if square_env not in _SQUARE_BASE_URLS:
+            raise SettingsError(f"SQUARE_ENV debe ser sandbox o production (recibido {square_env!r})")
+        read_timeout = _number(env, "SQUARE_READ_TIMEOUT", "30", minimum=0.1)
+        log_level = env.get("LOG_LEVEL", "INFO")
+        if log_level.upper() not in _LOG_LEVELS:
+            raise SettingsError(f"LOG_LEVEL debe ser uno de {', '.join(_LOG_LEVELS)} (recibido {log_level!r})")
+        log_format = env.get("LOG_FORMAT", "json")
+        if log_format not in ("json", "text"):
+            raise SettingsError(f"LOG_FORMAT debe ser json o text (recibido {log_format!r})")
+        cards_page_max = _number(env, "CARDS_PAGE_MAX", "200", int, minimum=1)
+        return cls(
+            square_env=square_env,
+            square_base_url=env.get("SQUARE_BASE_URL", _SQUARE_BASE_URLS[square_env]).rstrip("/"),  # ej. bench/fake_upstream.py
+            square_access_token=env.get("SQUARE_ACCESS_TOKEN", ""),
+            square_location_id=env.get("SQUARE_LOCATION_ID", ""),
+            square_pool_size=_number(env, "SQUARE_POOL_SIZE", "20", int, minimum=1),
+            square_connect_retries=_number(env, "SQUARE_CONNECT_RETRIES", "2", int),
+            square_connect_timeout=_number(env, "SQUARE_CONNECT_TIMEOUT", "5", minimum=0.1),
+            square_read_timeout=read_timeout,
+            square_min_read_timeout=min(_number(env, "SQUARE_MIN_READ_TIMEOUT", "5", minimum=0.1), read_timeout),
+            square_timeout_p99_factor=_number(env, "SQUARE_TIMEOUT_P99_FACTOR", "3", minimum=1),
+            square_webhook_signature_key=env.get("SQUARE_WEBHOOK_SIGNATURE_KEY") or None,
+            # URL exacta registrada en Square (detrás de un proxy request.url no coincide)
+            square_webhook_url=env.get("SQUARE_WEBHOOK_URL") or None,
+            supabase_url=env.get("SUPABASE_URL") or None,
+            supabase_key=env.get("SUPABASE_SERVICE_ROLE") or env.get("SUPABASE_KEY") or None,
+            supabase_reconnect_seconds=_number(env, "SUPABASE_RECONNECT_SECONDS", "5"),
+            internal_api_key=env.get("INTERNAL_API_KEY") or None,
+            # Proxies delante de la app (Render: 1) cuyo X-Forwarded-For se respeta; 0 = conexión directa
+            trusted_proxies=_number(env, "TRUSTED_PROXIES", "1", int),
+            log_level=log_level.upper(),
+            log_format=log_format,
+            log_queue_size=_number(env, "LOG_QUEUE_SIZE", "10000", int),
+            breakers={name: _breaker(env, name) for name in ("square", "supabase")},
+            rate_limit_user=_rate(env, "RATE_LIMIT_USER", "10/60"),
+            rate_limit_api_key=_rate(env, "RATE_LIMIT_API_KEY", "600/60"),
+            square_max_in_flight=_number(env, "SQUARE_MAX_IN_FLIGHT", "100", int),
+            square_in_flight_wait=_number(env, "SQUARE_IN_FLIGHT_WAIT", "2"),
+            shared_store_path=env.get("SHARED_STORE_PATH") or None,
+            shared_store_default_path=env.get("SHARED_STORE_DEFAULT_PATH", "shared_store.db"),
+            outbox_db=env.get("OUTBOX_DB", "outbox.db"),
+            payment_jobs_db=env.get("PAYMENT_JOBS_DB", "payment_jobs.db"),
+            card_sync_db=env.get("CARD_SYNC_DB", "card_sync.db"),
+            reconcile_db=env.get("RECONCILE_DB", "reconcile.db"),
+            customer_cache_size=_number(env, "CUSTOMER_CACHE_SIZE", "50000", int, minimum=1),
+            customer_cache_ttl=_number(env, "CUSTOMER_CACHE_TTL", "86400"),
+            cards_cache_size=_number(env, "CARDS_CACHE_SIZE", "10000", int, minimum=1),
+            cards_cache_ttl=_number(env, "CARDS_CACHE_TTL", "300"),
+            card_index_size=_number(env, "CARD_INDEX_SIZE", "100000", int, minimum=1),
+            card_index_ttl=_number(env, "CARD_INDEX_TTL", "3600"),
+            idempotency_cache_size=_number(env, "IDEMPOTENCY_CACHE_SIZE", "10000", int, minimum=1),
+            idempotency_ttl=_number(env, "IDEMPOTENCY_TTL", "86400"),
+            cards_page_size=min(_number(env, "CARDS_PAGE_SIZE", "50", int, minimum=1), cards_page_max),
+            cards_page_max=cards_page_max,
+            batch_max_items=_number(env, "BATCH_MAX_ITEMS", "500", int, minimum=1),
+            batch_sync_max_items=_number(env, "BATCH_SYNC_MAX_ITEMS", "100", int),
+            batch_max_concurrency=_number(env, "BATCH_MAX_CONCURRENCY", "8", int, minimum=1),
+            batch_pool_size=_number(env, "BATCH_POOL_SIZE", "16", int, minimum=1),
+            sdk_card_max_age=_number(env, "SDK_CARD_MAX_AGE", "300", int),
+            # "0" = ninguna tabla (todo en línea)
+            supabase_outbox=frozenset(t.strip() for t in env.get("SUPABASE_OUTBOX", "user_square").split(",")
+                                      if t.strip() not in ("", "0")),
+            outbox_batch=_number(env, "OUTBOX_BATCH", "100", int, minimum=1),
+            outbox_poll_interval=_number(env, "OUTBOX_POLL_MS", "200") / 1000,
+            outbox_max_attempts=_number(env, "OUTBOX_MAX_ATTEMPTS", "10", int, minimum=1),
+            payment_job_workers=_number(env, "PAYMENT_JOB_WORKERS", "4", int, minimum=1),
+            payment_jobs_retention=_number(env, "PAYMENT_JOBS_RETENTION", str(7 * 86400)),
+            square_webhook_batch=_number(env, "SQUARE_WEBHOOK_BATCH", "100", int, minimum=1),
+            square_webhook_flush_interval=_number(env, "SQUARE_WEBHOOK_FLUSH_MS", "500") / 1000,
+            square_webhook_queue_size=_number(env, "SQUARE_WEBHOOK_QUEUE_SIZE", "10000", int),
+            square_webhook_max_attempts=_number(env, "SQUARE_WEBHOOK_MAX_ATTEMPTS", "5", int, minimum=1),
+            payment_link_pool_amounts=_amounts(env, "PAYMENT_LINK_POOL_AMOUNTS"),
+            payment_link_pool_size=_number(env, "PAYMENT_LINK_POOL_SIZE", "5", int),
+            payment_link_pool_low_water=_number(env, "PAYMENT_LINK_POOL_LOW_WATER", "2", int),
+            payment_link_pool_ttl=_number(env, "PAYMENT_LINK_POOL_TTL", "12") * 3600,
+            card_sync_interval=_number(env, "CARD_SYNC_INTERVAL", "900"),
+            card_sync_pages=_number(env, "CARD_SYNC_PAGES", "10", int, minimum=1),
+            card_sync_page_size=_number(env, "CARD_SYNC_PAGE_SIZE", "100", int, minimum=1),
+            card_sync_disable_orphans_after=_number(env, "CARD_SYNC_DISABLE_ORPHANS_AFTER", "0"),
+            reconcile_page_size=_number(env, "RECONCILE_PAGE_SIZE", "100", int, minimum=1),
+            health_probe_interval=_number(env, "HEALTH_PROBE_INTERVAL", "15"),
+            health_probe_slow_ms=_number(env, "HEALTH_PROBE_SLOW_MS", "1000"),
+            health_probe_down_after=_number(env, "HEALTH_PROBE_DOWN_AFTER", "3", int, minimum=1),
+            health_probe_timeout=_number(env, "HEALTH_PROBE_TIMEOUT", "5", minimum=0.1),
+        )
+
+    @property
+    def square_ready(self):
+        return bool(self.square_access_token and self.square_location_id)
+
+    @property
+    def supabase_configured(self):
+        return bool(self.supabase_url and self.supabase_key)
+
+
+_settings = None
+_settings_lock = threading.Lock()
+
+def get_settings() -> Settings:
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings.from_env()
+    return _settings
@@ -0,0 +1,107 @@
+"""Store local compartido entre workers de gunicorn (SQLite en disco local).
+
+Se activa con SHARED_STORE_PATH (ej. /tmp/cubalink23-shared.db). Sin esa variable
+get_store() devuelve None y cada worker usa solo su caché en memoria.
+
+get_default_store() siempre devuelve un store (SHARED_STORE_PATH o, sin él,
+SHARED_STORE_DEFAULT_PATH): lo usan las invalidaciones entre workers (ej.
+generación de tarjetas), que no pueden depender de una variable opcional.
+"""
+import os, json, time, sqlite3, threading
+from settings import get_settings
+
+class SharedStore:
+    """KV con TTL sobre SQLite (WAL): una conexión por hilo y por proceso"""
+
+    def __init__(self, path:str, purge_interval:float=60):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._purged_at = time.monotonic()
+        self._local = threading.local()
+        self._conn().executescript(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL);"
+            "CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at);"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key:str, default=None):
+        row = self._conn().execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return default
+        return json.loads(row[0])
+
+    def _maybe_purge(self):
+        # Las claves vencidas (buckets por usuario, generaciones...) se borran en las escrituras,
+        # como mucho una vez por purge_interval en cada proceso: el archivo no crece sin límite
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            self._purged_at = time.monotonic()
+            self.purge_expired()
+
+    def set(self, key:str, value, ttl=None):
+        self._maybe_purge()
+        expires_at = time.time() + ttl if ttl else None
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at),
+        )
+
+    def update(self, key:str, fn, ttl=None):
+        """Read-modify-write atómico entre workers (BEGIN IMMEDIATE).
+        fn(valor actual o None) -> (nuevo valor, resultado); devuelve resultado"""
+        self._maybe_purge()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            current = json.loads(row[0]) if row is not None and (row[1] is None or row[1] > time.time()) else None
+            value, result = fn(current)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl if ttl else None),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def delete(self, key:str):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        self._conn().execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    path = get_settings().shared_store_path
+    if not path:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SharedStore(path)
+    return _store
+
+_default_store = None
+
+def get_default_store():
+    global _default_store
+    if store := get_store():
+        return store
+    if _default_store is None:
+        with _store_lock:
+            if _default_store is None:
+                _default_store = SharedStore(get_settings().shared_store_default_path)
+    return _default_store
@@ -0,0 +1,26 @@
+-- Escrituras que llegan desde el outbox local (outbox.py): en lote e idempotentes.
+
+-- user_square: el outbox hace upsert on_conflict=user_id (un reintento no duplica)
+create unique index if not exists user_square_user_id_key
+    on public.user_square (user_id);
+
+-- Varias tarjetas en un round trip (POST /rest/v1/rpc/save_payment_cards).
+-- Cada elemento pasa por save_payment_card (sql/save_payment_card.sql), en orden:
+-- is_default se decide igual que en el guardado individual.
+create or replace function public.save_payment_cards(p_cards jsonb)
+returns setof public.payment_cards
+language plpgsql
+as $$
+declare
+    c public.payment_cards;
+begin
+    -- jsonb_populate_record: cada campo toma el tipo de su columna
+    for c in select * from jsonb_populate_recordset(null::public.payment_cards, p_cards)
+    loop
+        return query select * from public.save_payment_card(
+            c.user_id, c.square_card_id, c.square_customer_id, c.card_type, c.last4,
+            c.exp_month, c.exp_year, c.zip_code, c.holder_name
+        );
+    end loop;
+end;
+$$;
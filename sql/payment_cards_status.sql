@@ -0,0 +1,8 @@
+-- Estado de la tarjeta según Square (card_sync.py). Los listados y cobros solo usan 'active'.
+alter table public.payment_cards
+    add column if not exists status text not null default 'active'
+        check (status in ('active', 'expired', 'disabled')),
+    add column if not exists synced_at timestamptz;
+
+create index if not exists payment_cards_user_active
+    on public.payment_cards (user_id, created_at desc) where status = 'active';
@@ -0,0 +1,74 @@
+-- Guardar metadata de tarjeta en un solo round trip (POST /rest/v1/rpc/save_payment_card).
+-- Decide is_default dentro de la misma transacción: dos guardados concurrentes del
+-- mismo usuario se serializan con un advisory lock, así solo uno queda como default.
+-- Reintentos con el mismo square_card_id actualizan la fila en vez de duplicarla.
+-- Solo cuentan las tarjetas activas: aplicar antes sql/payment_cards_status.sql.
+
+create unique index if not exists payment_cards_square_card_id_key
+    on public.payment_cards (square_card_id);
+
+-- Antes del índice: el guardado anterior (2 round trips) podía dejar varios defaults
+-- por usuario. Queda como default la tarjeta más vieja de cada uno.
+update public.payment_cards pc
+   set is_default = false
+ where pc.is_default
+   and exists (
+       select 1 from public.payment_cards older
+        where older.user_id = pc.user_id
+          and older.is_default
+          and (older.created_at, older.id) < (pc.created_at, pc.id)
+   );
+
+create unique index if not exists payment_cards_one_default_per_user
+    on public.payment_cards (user_id) where is_default;
+
+create or replace function public.save_payment_card(
+    p_user_id            public.payment_cards.user_id%type,
+    p_square_card_id     public.payment_cards.square_card_id%type,
+    p_square_customer_id public.payment_cards.square_customer_id%type,
+    p_card_type          public.payment_cards.card_type%type,
+    p_last4              public.payment_cards.last4%type,
+    p_exp_month          public.payment_cards.exp_month%type,
+    p_exp_year           public.payment_cards.exp_year%type,
+    p_zip_code           public.payment_cards.zip_code%type,
+    p_holder_name        public.payment_cards.holder_name%type
+)
+returns setof public.payment_cards
+language plpgsql
+as $$
+declare
+    v_default boolean;
+begin
+    perform pg_advisory_xact_lock(hashtext('payment_cards:' || p_user_id::text));
+
+    -- Default si el usuario no tiene otra tarjeta activa; las deshabilitadas/vencidas no cuentan
+    v_default := not exists (
+        select 1 from public.payment_cards
+         where user_id = p_user_id and status = 'active' and square_card_id <> p_square_card_id
+    );
+    if v_default then
+        -- Un default viejo en una tarjeta inactiva chocaría con payment_cards_one_default_per_user
+        update public.payment_cards
+           set is_default = false
+         where user_id = p_user_id and is_default and status <> 'active';
+    end if;
+
+    return query
+    insert into public.payment_cards as pc (
+        user_id, square_card_id, square_customer_id, card_type, last4,
+        exp_month, exp_year, zip_code, holder_name, is_default
+    )
+    values (
+        p_user_id, p_square_card_id, p_square_customer_id, p_card_type, p_last4,
+        p_exp_month, p_exp_year, p_zip_code, p_holder_name, v_default
+    )
+    on conflict (square_card_id) do update set
+        card_type   = excluded.card_type,
+        last4       = excluded.last4,
+        exp_month   = excluded.exp_month,
+        exp_year    = excluded.exp_year,
+        zip_code    = excluded.zip_code,
+        holder_name = excluded.holder_name
+    returning pc.*;
+end;
+$$;
@@ -0,0 +1,56 @@
+-- Destino de los webhooks de Square (webhooks.py): upserts en lote por el flusher.
+
+create table if not exists public.square_webhook_events (
+    event_id    text primary key,
+    type        text not null,
+    merchant_id text,
+    object_id   text,
+    created_at  timestamptz,
+    received_at timestamptz not null default now(),
+    payload     jsonb not null
+);
+
+create table if not exists public.square_payments (
+    payment_id        text primary key,
+    status            text,
+    amount            bigint,
+    currency          text,
+    customer_id       text,
+    order_id          text,
+    square_card_id    text,
+    receipt_url       text,
+    square_created_at timestamptz,
+    square_updated_at timestamptz,
+    version           text
+);
+
+create index if not exists square_payments_order_id on public.square_payments (order_id);
+
+-- Upsert en lote que respeta el orden de Square (POST /rest/v1/rpc/upsert_square_payments):
+-- los eventos pueden llegar desordenados; un payment.created (APPROVED) tardío no pisa
+-- un COMPLETED ya guardado con square_updated_at más nuevo.
+create or replace function public.upsert_square_payments(p_rows jsonb)
+returns void
+language sql
+as $$
+    insert into public.square_payments as sp (
+        payment_id, status, amount, currency, customer_id, order_id, square_card_id,
+        receipt_url, square_created_at, square_updated_at, version
+    )
+    select payment_id, status, amount, currency, customer_id, order_id, square_card_id,
+           receipt_url, square_created_at, square_updated_at, version
+    from jsonb_populate_recordset(null::public.square_payments, p_rows)
+    on conflict (payment_id) do update set
+        status            = excluded.status,
+        amount            = excluded.amount,
+        currency          = excluded.currency,
+        customer_id       = excluded.customer_id,
+        order_id          = excluded.order_id,
+        square_card_id    = excluded.square_card_id,
+        receipt_url       = excluded.receipt_url,
+        square_created_at = excluded.square_created_at,
+        square_updated_at = excluded.square_updated_at,
+        version           = excluded.version
+    where sp.square_updated_at is null
+       or excluded.square_updated_at >= sp.square_updated_at;
+$$;
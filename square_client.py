@@ -1,11 +1,14 @@
-import os, uuid, requests
+import os, uuid, threading, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from breaker import get_breaker, UpstreamUnavailable
+from metrics import observe_upstream, operation_name
+from settings import get_settings
+from ratelimit import limiter
 
 def _cfg():
-    env = os.getenv("SQUARE_ENV", "sandbox").lower()
-    base = "https://connect.squareup.com" if env == "production" else "https://connect.squareupsandbox.com"
-    token = os.getenv("SQUARE_ACCESS_TOKEN", "")
-    loc   = os.getenv("SQUARE_LOCATION_ID", "")
-    return env, base, token, loc
+    s = get_settings()
+    return s.square_env, s.square_base_url, s.square_access_token, s.square_location_id
 
 def _headers(token:str):
     return {
@@ -14,58 +17,111 @@ def _headers(token:str):
         "Content-Type": "application/json"
     }
 
+# ====================== TRANSPORTE HTTP (pool + keep-alive) ======================
+# Una sola Session por proceso: reutiliza conexiones TCP/TLS a Square entre requests.
+# Se recrea si cambia el PID (workers de gunicorn hechos con fork tras preload).
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def _timeouts():
+    """(connect, read) en segundos; el read se adapta al p99 observado (entre MIN y MAX)"""
+    s = get_settings()
+    read = get_breaker("square").adaptive_timeout(
+        floor=s.square_min_read_timeout, ceiling=s.square_read_timeout, factor=s.square_timeout_p99_factor,
+    )
+    return (s.square_connect_timeout, read)
+
+def _build_session():
+    pool_size = get_settings().square_pool_size
+    connect_retries = get_settings().square_connect_retries
+    # Solo se reintentan errores de conexión: el request nunca llegó a Square.
+    # Nunca lecturas ni status (POST no idempotentes); el body reenviado es el mismo,
+    # así que conserva el mismo idempotency_key.
+    retry = Retry(
+        total=connect_retries, connect=connect_retries, read=0, status=0, other=0, redirect=0,
+        allowed_methods=None, backoff_factor=0.1, raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+def _transport():
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session, _session_pid = _build_session(), pid
+    return _session
+
+def _upstream_failed(r):
+    return r.status_code >= 500 or r.status_code == 429
+
+def square_request(method:str, path:str, json=None, params=None):
+    """Todas las llamadas a Square pasan por aquí (pool compartido, timeouts connect/read, circuit breaker,
+    tope global en curso). Con el circuito abierto, o sin cupo, lanza UpstreamUnavailable sin tocar la red."""
+    env, base, token, _ = _cfg()
+    limiter.acquire_wait()
+    try:
+        return get_breaker("square").call(
+            observe_upstream, "square", operation_name(method, path),
+            _transport().request, method, f"{base}{path}",
+            headers=_headers(token), json=json, params=params, timeout=_timeouts(),
+            is_error=_upstream_failed,
+        )
+    finally:
+        limiter.release()
+
+def probe_location(timeout:float=5):
+    """GET /v2/locations/{id} fuera del circuit breaker (probes de salud); lanza si no responde 2xx"""
+    env, base, token, loc = _cfg()
+    r = _transport().get(f"{base}/v2/locations/{loc}", headers=_headers(token),
+                         timeout=(get_settings().square_connect_timeout, timeout))
+    r.raise_for_status()
+    return r.json()["location"]
+
 def ensure_config_ok():
     env, base, token, loc = _cfg()
     ok = bool(token and loc)
     return ok, {"env": env, "has_token": bool(token), "has_location": bool(loc), "base": base}
 
-def create_customer(given_name=None, email=None, reference_id=None):
-    env, base, token, _ = _cfg()
-    r = requests.post(
-        f"{base}/v2/customers",
-        headers=_headers(token),
-        json={"idempotency_key": str(uuid.uuid4()), "given_name": given_name, "email_address": email, "reference_id": reference_id},
-        timeout=30,
-    )
-    r.raise_for_status(); return r.json()["customer"]
+# ====================== BODIES (compartidos con square_client_async) ======================
 
-def create_card_on_file(customer_id:str, nonce:str):
-    # Cards API actual: POST /v2/cards  (no usar endpoint deprecated /customers/{id}/cards)
-    env, base, token, _ = _cfg()
-    body = {
+def _customer_body(given_name=None, email=None, reference_id=None, idempotency_key=None):
+    return {"idempotency_key": idempotency_key or str(uuid.uuid4()), "given_name": given_name, "email_address": email, "reference_id": reference_id}
+
+def _card_body(customer_id:str, nonce:str, reference_id:str=None):
+    card = { "customer_id": customer_id }
+    if reference_id: card["reference_id"] = reference_id
+    return {
         "idempotency_key": str(uuid.uuid4()),
         "source_id": nonce,
-        "card": { "customer_id": customer_id }
+        "card": card
     }
-    r = requests.post(f"{base}/v2/cards", headers=_headers(token), json=body, timeout=30)
-    r.raise_for_status(); return r.json()["card"]
 
-def create_payment_with_card(customer_id:str, card_id:str, amount_cents:int, currency="USD", note=None):
-    env, base, token, loc = _cfg()
-    body = {
-        "idempotency_key": str(uuid.uuid4()),
+def _card_payment_body(customer_id:str, card_id:str, amount_cents:int, currency="USD", note=None, idempotency_key=None, postal_code=None):
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
         "amount_money": {"amount": amount_cents, "currency": currency},
         "customer_id": customer_id,
         "source_id": card_id,  # ✅ CORREGIDO: usar source_id para Card on File
-        "location_id": loc,
+        "location_id": _cfg()[3],
         "note": note,
-        # ✅ AGREGAR ZIP CODE por defecto para sandbox
+        # ✅ ZIP guardado con la tarjeta; por defecto para sandbox
         "billing_address": {
-            "postal_code": "12345"  # ZIP code por defecto para sandbox
+            "postal_code": postal_code or "12345"
         }
     }
-    r = requests.post(f"{base}/v2/payments", headers=_headers(token), json=body, timeout=30)
-    if r.status_code != 200:
-        return {"error": r.json() if r.content else {"message": "Payment failed"}, "status_code": r.status_code}
-    return r.json()["payment"]
 
-def create_payment_with_nonce(nonce:str, amount_cents:int, currency="USD", note=None, customer_id=None):
-    env, base, token, loc = _cfg()
-    body = {
-        "idempotency_key": str(uuid.uuid4()),
+def _nonce_payment_body(nonce:str, amount_cents:int, currency="USD", note=None, customer_id=None, idempotency_key=None):
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
         "amount_money": {"amount": amount_cents, "currency": currency},
         "source_id": nonce,
-        "location_id": loc,
+        "location_id": _cfg()[3],
         "customer_id": customer_id,
         "note": note,
         # ✅ AGREGAR ZIP CODE por defecto para sandbox
@@ -73,8 +129,106 @@ def create_payment_with_nonce(nonce:str, amount_cents:int, currency="USD", note=
             "postal_code": "12345"  # ZIP code por defecto para sandbox
         }
     }
-    r = requests.post(f"{base}/v2/payments", headers=_headers(token), json=body, timeout=30)
+
+def _payment_link_body(amount_cents:int, currency="USD", note=None, idempotency_key=None):
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "quick_pay": {
+            "location_id": _cfg()[3],
+            "name": f"Recarga ${amount_cents/100:.2f}",
+            "price_money": {"amount": amount_cents, "currency": currency},
+        },
+        "description": note,
+        "checkout_options": {
+            "redirect_url": "cubalink23://payment-success",
+            "ask_for_shipping_address": False,
+        },
+    }
+
+def _unavailable_result(e:UpstreamUnavailable):
+    # Mismo formato de error que Square para que los handlers lo traten igual
+    return {
+        "error": {"errors": [{"category": "API_ERROR", "code": e.code, "detail": str(e)}]},
+        "status_code": e.status_code,
+        "retry_after": round(e.retry_after),
+    }
+
+def _payment_result(status_code:int, content:bytes, data):
+    # Devolver el error de Square en lugar de hacer raise_for_status
+    if status_code != 200:
+        return {"error": data if content else {"message": "Payment failed"}, "status_code": status_code}
+    return data["payment"]
+
+# ====================== API ======================
+
+def create_customer(given_name=None, email=None, reference_id=None, idempotency_key=None):
+    r = square_request("POST", "/v2/customers", json=_customer_body(given_name, email, reference_id, idempotency_key))
+    r.raise_for_status(); return r.json()["customer"]
+
+def create_card_on_file(customer_id:str, nonce:str, reference_id:str=None):
+    # Cards API actual: POST /v2/cards  (no usar endpoint deprecated /customers/{id}/cards)
+    r = square_request("POST", "/v2/cards", json=_card_body(customer_id, nonce, reference_id))
+    r.raise_for_status(); return r.json()["card"]
+
+def list_cards_page(cursor=None, include_disabled=True, limit=100):
+    """Una página de GET /v2/cards → (cards, siguiente cursor o None)"""
+    params = {"include_disabled": "true" if include_disabled else "false", "sort_order": "ASC", "limit": limit}
+    if cursor: params["cursor"] = cursor
+    r = square_request("GET", "/v2/cards", params=params)
+    r.raise_for_status()
+    data = r.json()
+    return data.get("cards", []), data.get("cursor")
+
+def disable_card(card_id:str):
+    """POST /v2/cards/{id}/disable. False si Square ya no la tiene (404)"""
+    r = square_request("POST", f"/v2/cards/{card_id}/disable")
+    if r.status_code == 404:
+        return False
+    r.raise_for_status(); return True
+
+def create_payment_with_card(customer_id:str, card_id:str, amount_cents:int, currency="USD", note=None, idempotency_key=None, postal_code=None):
+    try:
+        r = square_request("POST", "/v2/payments", json=_card_payment_body(customer_id, card_id, amount_cents, currency, note, idempotency_key, postal_code))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
+    return _payment_result(r.status_code, r.content, r.json() if r.content else None)
+
+def list_payments(begin_time=None, end_time=None, sort_order="ASC", limit=100):
+    """Generador sobre GET /v2/payments (RFC 3339, begin inclusivo / end exclusivo).
+    Pide la siguiente página solo cuando se consumió la anterior: memoria constante."""
+    params = {"sort_order": sort_order, "limit": limit}
+    if begin_time: params["begin_time"] = begin_time
+    if end_time: params["end_time"] = end_time
+    if loc := _cfg()[3]: params["location_id"] = loc
+    while True:
+        r = square_request("GET", "/v2/payments", params=params)
+        r.raise_for_status()
+        data = r.json()
+        yield from data.get("payments", [])
+        if not data.get("cursor"):
+            return
+        params["cursor"] = data["cursor"]
+
+def create_payment_with_nonce(nonce:str, amount_cents:int, currency="USD", note=None, customer_id=None, idempotency_key=None):
+    try:
+        r = square_request("POST", "/v2/payments", json=_nonce_payment_body(nonce, amount_cents, currency, note, customer_id, idempotency_key))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
+    return _payment_result(r.status_code, r.content, r.json() if r.content else None)
+
+def delete_payment_link(link_id:str):
+    """DELETE /v2/online-checkout/payment-links/{id} (el link deja de cobrar). False si Square ya no lo tiene (404)"""
+    r = square_request("DELETE", f"/v2/online-checkout/payment-links/{link_id}")
+    if r.status_code == 404:
+        return False
+    r.raise_for_status(); return True
+
+def create_quick_pay_link(amount_cents:int, currency="USD", note=None, idempotency_key=None):
+    """Payment Link quick pay → payment_link, o {"error", "status_code"} como los pagos"""
+    try:
+        r = square_request("POST", "/v2/online-checkout/payment-links", json=_payment_link_body(amount_cents, currency, note, idempotency_key))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
     if r.status_code != 200:
-        # Devolver el error de Square en lugar de hacer raise_for_status
-        return {"error": r.json() if r.content else {"message": "Payment failed"}, "status_code": r.status_code}
-    return r.json()["payment"]
+        return {"error": r.json() if r.content else {"message": "Error creating payment link"}, "status_code": r.status_code}
+    return r.json()["payment_link"]
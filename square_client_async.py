@@ -0,0 +1,156 @@
+"""Versión asyncio de square_client (mismos bodies, mismas respuestas, mismas firmas).
+
+Para scripts/servicios asyncio:  await create_payment_with_nonce(...)
+Las funciones síncronas de square_client siguen funcionando igual.
+"""
+import os, time, asyncio, weakref, httpx
+from breaker import get_breaker, UpstreamUnavailable
+from metrics import observe_upstream_async, operation_name
+from settings import get_settings
+from ratelimit import limiter
+from square_client import (
+    _cfg, _headers, _timeouts, _customer_body, _card_body, _upstream_failed,
+    _card_payment_body, _nonce_payment_body, _payment_link_body, _payment_result, _unavailable_result,
+)
+
+# loop -> (pid, AsyncClient): los clientes httpx no se pueden compartir entre loops.
+# Débil por loop: el cliente de un loop ya recolectado no queda retenido.
+_clients = weakref.WeakKeyDictionary()
+
+def _build_client():
+    s = get_settings()
+    # httpx reintenta solo errores de conexión (request nunca enviado)
+    transport = httpx.AsyncHTTPTransport(retries=s.square_connect_retries)
+    return httpx.AsyncClient(
+        transport=transport,
+        limits=httpx.Limits(max_connections=s.square_pool_size, max_keepalive_connections=s.square_pool_size),
+    )
+
+def _client():
+    loop = asyncio.get_running_loop()
+    pid, client = _clients.get(loop, (None, None))
+    if client is None or client.is_closed or pid != os.getpid():
+        client = _build_client()
+        _clients[loop] = (os.getpid(), client)
+    return client
+
+def _timeout():
+    # Mismo read adaptativo (p99 del breaker) que el cliente síncrono
+    connect, read = _timeouts()
+    return httpx.Timeout(read, connect=connect)
+
+async def aclose():
+    """Cerrar el cliente del loop actual (al terminar el script)"""
+    _, client = _clients.pop(asyncio.get_running_loop(), (None, None))
+    if client is not None:
+        await client.aclose()
+
+async def square_request(method:str, path:str, json=None, params=None):
+    # Mismo circuit breaker, timeouts adaptativos, métricas y tope en curso que el cliente síncrono
+    env, base, token, _ = _cfg()
+    deadline = time.monotonic() + limiter.in_flight_wait
+    while not limiter.acquire():
+        if time.monotonic() >= deadline:
+            limiter.reject_in_flight()
+        await asyncio.sleep(0.05)
+    try:
+        breaker = get_breaker("square")
+        probe = breaker.before_call()
+        start = time.perf_counter()
+        try:
+            r = await observe_upstream_async(
+                "square", operation_name(method, path),
+                _client().request, method, f"{base}{path}",
+                headers=_headers(token), json=json, params=params, timeout=_timeout(),
+            )
+        except Exception:
+            breaker.record(time.perf_counter() - start, True)
+            raise
+        except BaseException:
+            # asyncio.CancelledError (wait_for, task cancelada): liberar la sonda sin contar falla
+            if probe:
+                breaker.release_probe()
+            raise
+        breaker.record(time.perf_counter() - start, _upstream_failed(r))
+        return r
+    finally:
+        limiter.release()
+
+async def probe_location(timeout:float=5):
+    """GET /v2/locations/{id} fuera del circuit breaker (probes de salud); lanza si no responde 2xx"""
+    env, base, token, loc = _cfg()
+    r = await _client().get(f"{base}/v2/locations/{loc}", headers=_headers(token),
+                            timeout=httpx.Timeout(timeout, connect=get_settings().square_connect_timeout))
+    r.raise_for_status()
+    return r.json()["location"]
+
+async def create_customer(given_name=None, email=None, reference_id=None, idempotency_key=None):
+    r = await square_request("POST", "/v2/customers", json=_customer_body(given_name, email, reference_id, idempotency_key))
+    r.raise_for_status(); return r.json()["customer"]
+
+async def create_card_on_file(customer_id:str, nonce:str, reference_id:str=None):
+    r = await square_request("POST", "/v2/cards", json=_card_body(customer_id, nonce, reference_id))
+    r.raise_for_status(); return r.json()["card"]
+
+async def list_cards_page(cursor=None, include_disabled=True, limit=100):
+    """Una página de GET /v2/cards → (cards, siguiente cursor o None)"""
+    params = {"include_disabled": "true" if include_disabled else "false", "sort_order": "ASC", "limit": limit}
+    if cursor: params["cursor"] = cursor
+    r = await square_request("GET", "/v2/cards", params=params)
+    r.raise_for_status()
+    data = r.json()
+    return data.get("cards", []), data.get("cursor")
+
+async def disable_card(card_id:str):
+    """POST /v2/cards/{id}/disable. False si Square ya no la tiene (404)"""
+    r = await square_request("POST", f"/v2/cards/{card_id}/disable")
+    if r.status_code == 404:
+        return False
+    r.raise_for_status(); return True
+
+async def create_payment_with_card(customer_id:str, card_id:str, amount_cents:int, currency="USD", note=None, idempotency_key=None, postal_code=None):
+    try:
+        r = await square_request("POST", "/v2/payments", json=_card_payment_body(customer_id, card_id, amount_cents, currency, note, idempotency_key, postal_code))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
+    return _payment_result(r.status_code, r.content, r.json() if r.content else None)
+
+async def list_payments(begin_time=None, end_time=None, sort_order="ASC", limit=100):
+    """Generador asíncrono sobre GET /v2/payments:  async for payment in list_payments(...)"""
+    params = {"sort_order": sort_order, "limit": limit}
+    if begin_time: params["begin_time"] = begin_time
+    if end_time: params["end_time"] = end_time
+    if loc := _cfg()[3]: params["location_id"] = loc
+    while True:
+        r = await square_request("GET", "/v2/payments", params=params)
+        r.raise_for_status()
+        data = r.json()
+        for payment in data.get("payments", []):
+            yield payment
+        if not data.get("cursor"):
+            return
+        params["cursor"] = data["cursor"]
+
+async def create_payment_with_nonce(nonce:str, amount_cents:int, currency="USD", note=None, customer_id=None, idempotency_key=None):
+    try:
+        r = await square_request("POST", "/v2/payments", json=_nonce_payment_body(nonce, amount_cents, currency, note, customer_id, idempotency_key))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
+    return _payment_result(r.status_code, r.content, r.json() if r.content else None)
+
+async def delete_payment_link(link_id:str):
+    """DELETE /v2/online-checkout/payment-links/{id}. False si Square ya no lo tiene (404)"""
+    r = await square_request("DELETE", f"/v2/online-checkout/payment-links/{link_id}")
+    if r.status_code == 404:
+        return False
+    r.raise_for_status(); return True
+
+async def create_quick_pay_link(amount_cents:int, currency="USD", note=None, idempotency_key=None):
+    """Payment Link quick pay → payment_link, o {"error", "status_code"} como los pagos"""
+    try:
+        r = await square_request("POST", "/v2/online-checkout/payment-links", json=_payment_link_body(amount_cents, currency, note, idempotency_key))
+    except UpstreamUnavailable as e:
+        return _unavailable_result(e)
+    if r.status_code != 200:
+        return {"error": r.json() if r.content else {"message": "Error creating payment link"}, "status_code": r.status_code}
+    return r.json()["payment_link"]
@@ -0,0 +1,68 @@
+"""Página estática servida desde memoria con variantes pre-comprimidas.
+
+Se lee una vez; identity, gzip y br (`Brotli` en requirements.txt) se comprimen al
+cargar. ETag = hash del contenido (+ sufijo por encoding), If-None-Match → 304.
+reload() vuelve a leer el archivo (deploy sin reiniciar el worker).
+"""
+import gzip, hashlib, threading
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # opcional: sin brotli se sirve gzip
+    brotli = None
+
+class StaticPage:
+    def __init__(self, path:str, mimetype="text/html; charset=utf-8", max_age:int=300):
+        self.path = path
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = None
+        self._variants = {}   # encoding -> bytes ("identity", "gzip", "br")
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Leer y comprimir de nuevo; False si el archivo no existe (se sigue sirviendo lo anterior)"""
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return False
+        variants = {"identity": raw, "gzip": gzip.compress(raw, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(raw, quality=11)
+        with self._lock:
+            self._variants = variants
+            self.etag = hashlib.sha256(raw).hexdigest()[:32]
+        return True
+
+    @property
+    def loaded(self):
+        return bool(self._variants)
+
+    def _encoding(self, accept_encodings):
+        for encoding in ("br", "gzip"):
+            if encoding in self._variants and accept_encodings[encoding] > 0:
+                return encoding
+        return "identity"
+
+    def response(self, request):
+        variants, etag = self._variants, self.etag
+        encoding = self._encoding(request.accept_encodings)
+        tag = etag if encoding == "identity" else f"{etag}-{encoding}"
+        # Mismo contenido en cualquier encoding: cualquier variante conocida vale para el 304
+        known = {etag, f"{etag}-gzip", f"{etag}-br"}
+        if any(t in known for t in request.if_none_match.as_set()):
+            response = Response(status=304)
+        else:
+            response = Response(variants[encoding], mimetype=self.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(tag)
+        response.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    def stats(self):
+        return {"etag": self.etag, "sizes": {k: len(v) for k, v in self._variants.items()}}
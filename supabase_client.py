@@ -0,0 +1,57 @@
+"""Cliente Supabase perezoso: uno por worker, creado en el primer uso.
+
+Importar la app no toca la red ni el entorno de Supabase (compatible con preload
+de gunicorn). Si crear el cliente falla se reintenta tras SUPABASE_RECONNECT_SECONDS;
+tras un error de conexión reset() lo descarta y el siguiente uso crea uno nuevo.
+"""
+import os, time, threading
+import httpx
+from postgrest.exceptions import APIError
+from supabase import create_client
+from settings import get_settings
+import log
+
+# Errores de transporte que dejan el pool HTTP del cliente en mal estado
+CONNECTION_ERRORS = (httpx.NetworkError, httpx.RemoteProtocolError)
+
+# SQLSTATE / PostgREST de errores del request (datos, constraints, esquema, parseo):
+# Supabase respondió bien, no cuentan para el circuit breaker
+_CLIENT_ERROR_PREFIXES = ("22", "23", "42", "PGRST1", "PGRST2")
+
+def is_client_error(e):
+    """APIError por el request; un 5xx/503 o un código desconocido es una falla del upstream"""
+    code = getattr(e, "code", None)
+    return isinstance(e, APIError) and isinstance(code, str) and code.startswith(_CLIENT_ERROR_PREFIXES)
+
+_client = None
+_client_pid = None
+_failed_at = None
+_lock = threading.Lock()
+
+def get_supabase():
+    """Cliente del worker actual; None si no está configurado o el último intento falló hace poco"""
+    global _client, _client_pid, _failed_at
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    s = get_settings()
+    if not s.supabase_configured:
+        return None
+    with _lock:
+        if _client is not None and _client_pid == pid:
+            return _client
+        if _failed_at is not None and time.monotonic() - _failed_at < s.supabase_reconnect_seconds:
+            return None
+        try:
+            _client, _client_pid, _failed_at = create_client(s.supabase_url, s.supabase_key), pid, None
+        except Exception as e:
+            _client, _failed_at = None, time.monotonic()
+            log.error("supabase_client_failed", exc=e, url=s.supabase_url)
+            return None
+        log.info("supabase_client_created", url=s.supabase_url)
+        return _client
+
+def reset():
+    global _client
+    with _lock:
+        _client = None
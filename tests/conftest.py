@@ -0,0 +1,5 @@
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Stores SQLite de los módulos fuera del repo
+os.environ.setdefault("SHARED_STORE_DEFAULT_PATH", os.path.join(tempfile.mkdtemp(prefix="cubalink23-tests-"), "shared_store.db"))
@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+from breaker import CircuitBreaker, UpstreamUnavailable, HALF_OPEN, CLOSED
+import breaker
+import square_client_async
+
+def _open_breaker(name="test"):
+    b = CircuitBreaker(name, window=4, min_calls=2, open_seconds=0)
+    b.record(0.01, True)
+    b.record(0.01, True)
+    return b
+
+def _cancelled():
+    raise asyncio.CancelledError()
+
+
+def test_cancelled_probe_releases_half_open():
+    b = _open_breaker()
+    with pytest.raises(asyncio.CancelledError):
+        b.call(_cancelled)
+    assert b.state == HALF_OPEN
+    # La siguiente llamada vuelve a ser la sonda y cierra el circuito
+    assert b.call(lambda: "ok") == "ok"
+    assert b.state == CLOSED
+
+
+def test_async_cancelled_probe_releases_half_open(monkeypatch):
+    b = _open_breaker("square")
+    monkeypatch.setitem(breaker.breakers, "square", b)
+
+    class SlowClient:
+        async def request(self, *args, **kwargs):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(square_client_async, "_client", lambda: SlowClient())
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(square_client_async.square_request("GET", "/v2/locations"), 0.01)
+
+    asyncio.run(main())
+    assert b.state == HALF_OPEN
+    assert b.call(lambda: "ok") == "ok"
+    assert b.state == CLOSED
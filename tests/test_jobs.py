@@ -0,0 +1,44 @@
+import os, time
+import jobs
+
+def _wait_done(queue, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job["status"] == "done":
+            return job
+        time.sleep(0.02)
+    return queue.get(job_id)
+
+
+def test_running_job_from_previous_boot_with_same_pid_is_requeued(tmp_path):
+    jobs.register("test_echo", lambda payload, key: ({"echo": payload, "key": key}, 200))
+    path = str(tmp_path / "jobs.db")
+    journal = jobs.JobQueue(path)
+    now = time.time()
+    # Mismo pid que este proceso pero otra hora de arranque: un contenedor anterior
+    journal._conn().execute(
+        "INSERT INTO payment_jobs (id, kind, payload, idempotency_key, status, owner, created_at, updated_at) "
+        "VALUES ('stale', 'test_echo', '{\"n\": 1}', 'k1', 'running', ?, ?, ?)",
+        (f"{os.getpid()}:1", now, now),
+    )
+    queue = jobs.JobQueue(path)
+    queue.start()
+    job = _wait_done(queue, "stale")
+    assert job["status"] == "done"
+    assert job["result"] == {"echo": {"n": 1}, "key": "k1"}
+
+
+def test_running_job_of_live_process_is_not_requeued(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    journal = jobs.JobQueue(path)
+    now = time.time()
+    journal._conn().execute(
+        "INSERT INTO payment_jobs (id, kind, payload, idempotency_key, status, owner, created_at, updated_at) "
+        "VALUES ('live', 'test_echo', '{}', 'k2', 'running', ?, ?, ?)",
+        (jobs.boot_token(), now, now),
+    )
+    journal._recover()
+    assert journal.get("live")["status"] == "running"
+    assert jobs.owner_alive(jobs.boot_token())
+    assert not jobs.owner_alive(f"{os.getpid()}:1")
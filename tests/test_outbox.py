@@ -0,0 +1,56 @@
+from postgrest.exceptions import APIError
+import outbox
+
+def _outbox(tmp_path, **kwargs):
+    return outbox.Outbox(str(tmp_path / "outbox.db"), batch=100, **kwargs)
+
+def _handler(written):
+    def handler(payloads):
+        if any(p.get("bad") for p in payloads):
+            raise APIError({"code": "22P02", "message": "invalid input syntax for type uuid"})
+        written.extend(payloads)
+    return handler
+
+def _retry_now(box):
+    box._conn().execute("UPDATE outbox SET next_attempt_at = 0")
+
+
+def test_failing_head_does_not_block_other_users(tmp_path):
+    written = []
+    outbox.register("test_rows", _handler(written))
+    box = _outbox(tmp_path)
+    for i in range(400):
+        box.enqueue("test_rows", f"bad-{i}", {"bad": True})
+    box.enqueue("test_rows", "good", {"user_id": "good"})
+    for _ in range(5):
+        box.drain()
+    assert written == [{"user_id": "good"}]
+    assert box._count()["depth"] == 400
+
+
+def test_client_error_goes_to_dead_letter(tmp_path):
+    written = []
+    outbox.register("test_rows", _handler(written))
+    box = _outbox(tmp_path)
+    box.enqueue("test_rows", "u1", {"bad": True})
+    box.enqueue("test_rows", "u1", {"n": 2})
+    box.drain()   # el lote falla entero
+    _retry_now(box)
+    box.drain()   # la fila mala va sola → outbox_dead; la siguiente del usuario se escribe
+    assert box._count()["depth"] == 0
+    assert box._count()["dead"] == 1
+    assert written == [{"n": 2}]
+
+
+def test_transient_error_dead_letters_after_max_attempts(tmp_path):
+    def handler(payloads):
+        raise RuntimeError("timeout")
+    outbox.register("test_flaky", handler)
+    box = _outbox(tmp_path, max_attempts=3)
+    box.enqueue("test_flaky", "u1", {})
+    for _ in range(2):
+        box.drain()
+        _retry_now(box)
+    assert box._count()["depth"] == 1
+    box.drain()
+    assert box._count() | {"oldest": None} == {"depth": 0, "dead": 1, "oldest": None, "retrying": 0, "max_attempts": 0}
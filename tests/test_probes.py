@@ -0,0 +1,21 @@
+from probes import Prober, OK, DEGRADED, DISABLED
+
+
+def test_interval_zero_reports_disabled_not_degraded():
+    prober = Prober(interval=0)
+    prober.register("square", lambda: None)
+    prober.start()
+    snap = prober.snapshot()
+    assert snap["upstreams"]["square"]["status"] == DISABLED
+    assert snap["status"] == DISABLED
+
+
+def test_disabled_upstream_left_out_of_overall():
+    prober = Prober(interval=15)
+    prober.register("square", lambda: None)
+    prober.register("supabase", lambda: None, enabled=lambda: False)
+    assert prober.snapshot()["status"] == DEGRADED   # square sin probes todavía
+    prober.probes["square"].run()
+    snap = prober.snapshot()
+    assert snap["upstreams"]["supabase"]["status"] == DISABLED
+    assert snap["status"] == OK
@@ -0,0 +1,38 @@
+import gc
+import asyncio
+import inspect
+import square_client
+import square_client_async
+
+_API = [
+    "square_request", "probe_location", "create_customer", "create_card_on_file", "list_cards_page",
+    "disable_card", "create_payment_with_card", "list_payments", "create_payment_with_nonce",
+    "delete_payment_link", "create_quick_pay_link",
+]
+
+
+def test_same_signatures_as_sync_client():
+    for name in _API:
+        sync, async_ = getattr(square_client, name), getattr(square_client_async, name)
+        assert inspect.signature(sync) == inspect.signature(async_), name
+
+
+def test_client_per_loop_released_with_the_loop():
+    async def client():
+        return square_client_async._client()
+
+    loop = asyncio.new_event_loop()
+    first = loop.run_until_complete(client())
+    assert loop.run_until_complete(client()) is first
+    other = asyncio.new_event_loop()
+    assert other.run_until_complete(client()) is not first
+    assert len(square_client_async._clients) == 2
+
+    loop.run_until_complete(first.aclose())
+    loop.close()
+    del loop, first
+    gc.collect()
+    assert len(square_client_async._clients) == 1
+    other.run_until_complete(square_client_async.aclose())
+    other.close()
+    assert len(square_client_async._clients) == 0
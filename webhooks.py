@@ -0,0 +1,214 @@
+"""Webhooks de Square: verificación de firma, ack inmediato y escritura en lote a Supabase.
+
+POST /webhooks/square solo verifica la firma, descarta ids ya vistos y encola;
+un hilo por worker junta hasta SQUARE_WEBHOOK_BATCH eventos (o espera
+SQUARE_WEBHOOK_FLUSH_MS) y hace un upsert por tabla:
+  square_webhook_events (event_id)   todos los eventos
+  square_payments (payment_id)       estado de pagos (payment.created / payment.updated)
+Tablas en sql/square_webhooks.sql. Si Supabase falla el lote se reintenta; tras
+SQUARE_WEBHOOK_MAX_ATTEMPTS intentos se escribe evento por evento y los que Supabase
+rechaza por sus datos (ej. type null) van al log square_webhook_dead_letter.
+"""
+import os, time, hmac, queue, base64, hashlib, threading
+from postgrest.exceptions import APIError
+from cache import TTLCache
+from supabase_client import is_client_error
+from settings import get_settings
+import log
+
+PAYMENT_EVENTS = ("payment.created", "payment.updated")
+
+def signature_valid(signature_key:str, notification_url:str, body:bytes, signature:str):
+    """x-square-hmacsha256-signature = base64(HMAC-SHA256(key, url + body))"""
+    if not signature_key or not signature:
+        return False
+    digest = hmac.new(signature_key.encode(), notification_url.encode() + body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+def event_row(event:dict):
+    data = event.get("data") or {}
+    return {
+        "event_id": event["event_id"],
+        "type": event.get("type"),
+        "merchant_id": event.get("merchant_id"),
+        "object_id": data.get("id"),
+        "created_at": event.get("created_at"),
+        "payload": event,
+    }
+
+def payment_row(event:dict):
+    payment = ((event.get("data") or {}).get("object") or {}).get("payment")
+    if not payment:
+        return None
+    money = payment.get("amount_money") or {}
+    card = (payment.get("card_details") or {}).get("card") or {}
+    return {
+        "payment_id": payment["id"],
+        "status": payment.get("status"),
+        "amount": money.get("amount"),
+        "currency": money.get("currency"),
+        "customer_id": payment.get("customer_id"),
+        "order_id": payment.get("order_id"),
+        "square_card_id": card.get("id"),
+        "receipt_url": payment.get("receipt_url"),
+        "square_created_at": payment.get("created_at"),
+        "square_updated_at": payment.get("updated_at"),
+        "version": payment.get("version_token"),
+    }
+
+
+class WebhookQueue:
+    def __init__(self, batch:int=100, flush_interval:float=0.5, maxsize:int=10000, dedup_ttl:float=24 * 3600,
+                 max_attempts:int=5):
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.received = 0
+        self.duplicates = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.last_error = None
+        self._seen = TTLCache(maxsize=100000, ttl=dedup_ttl)   # event_id ya aceptado en este worker
+        self._queue = queue.Queue(maxsize)
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def put(self, event:dict):
+        """True si se aceptó (o ya estaba); False si la cola está llena (Square reintenta)"""
+        event_id = event["event_id"]
+        if self._seen.get(event_id) is not None:
+            self.duplicates += 1
+            return True
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            return False
+        self._seen.set(event_id, True)
+        self.received += 1
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    # ---------------- flusher ----------------
+
+    def _drain(self):
+        """Bloquea hasta el primer evento, luego junta lo que llegue durante flush_interval"""
+        events = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(events) < self.batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def write(self, events, client, run):
+        """Un upsert por tabla para todo el lote"""
+        rows = {e["event_id"]: event_row(e) for e in events}
+        payments = {}
+        for e in events:
+            if e.get("type") in PAYMENT_EVENTS and (row := payment_row(e)):
+                current = payments.get(row["payment_id"])
+                # Dentro del lote gana la versión más reciente del pago
+                if current is None or (row["square_updated_at"] or "") >= (current["square_updated_at"] or ""):
+                    payments[row["payment_id"]] = row
+        run(client().table("square_webhook_events").upsert(list(rows.values()), on_conflict="event_id", ignore_duplicates=True))
+        if payments:
+            try:
+                # Square puede entregar eventos desordenados: el rpc no pisa una versión más nueva
+                run(client().rpc("upsert_square_payments", {"p_rows": list(payments.values())}))
+            except APIError as e:
+                if e.code != "PGRST202":
+                    raise
+                log.warning("upsert_square_payments_rpc_missing")
+                run(client().table("square_payments").upsert(list(payments.values()), on_conflict="payment_id"))
+
+    def write_each(self, events, client, run):
+        """Evento por evento; los rechazados por sus datos se descartan al dead-letter log.
+        Devuelve los que fallaron por otra causa (Supabase caído), para seguir reintentando"""
+        remaining = []
+        for event in events:
+            try:
+                self.write([event], client, run)
+                self.flushed += 1
+            except Exception as e:
+                if not is_client_error(e):
+                    remaining.append(event)
+                    continue
+                self.dead_letters += 1
+                log.error("square_webhook_dead_letter", exc=e, event_id=event.get("event_id"), payload=event)
+        return remaining
+
+    def start(self, client, run):
+        """Una vez por proceso (después del fork de gunicorn)"""
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.maxsize)
+
+            def loop():
+                pending, attempts = [], 0
+                while True:
+                    if not pending:
+                        pending = self._drain()
+                    try:
+                        if client() is None:
+                            raise RuntimeError("Supabase no configurado")
+                        self.write(pending, client, run)
+                        self.flushed += len(pending)
+                        self.batches += 1
+                        self.last_error = None
+                        pending, attempts = [], 0
+                    except Exception as e:
+                        # El lote se conserva y se reintenta (los upserts son idempotentes)
+                        self.failures += 1
+                        attempts += 1
+                        self.last_error = str(e)
+                        log.error("square_webhook_flush_failed", exc=e, events=len(pending))
+                        if attempts >= self.max_attempts:
+                            # Un lote que siempre falla no bloquea al flusher: aislar el evento culpable
+                            try:
+                                pending = self.write_each(pending, client, run)
+                            except Exception as each_error:
+                                log.error("square_webhook_write_each_failed", exc=each_error)
+                            if not pending:
+                                attempts = 0
+                                continue
+                        time.sleep(min(30, 2 ** attempts))
+
+            threading.Thread(target=loop, name="square-webhooks", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def stats(self):
+        return {
+            "depth": self.depth(), "received": self.received, "duplicates": self.duplicates,
+            "flushed": self.flushed, "batches": self.batches, "failures": self.failures,
+            "dead_letters": self.dead_letters, "last_error": self.last_error,
+        }
+
+
+_webhooks = None
+_webhooks_lock = threading.Lock()
+
+def get_webhooks():
+    global _webhooks
+    if _webhooks is None:
+        with _webhooks_lock:
+            if _webhooks is None:
+                settings = get_settings()
+                _webhooks = WebhookQueue(
+                    batch=settings.square_webhook_batch,
+                    flush_interval=settings.square_webhook_flush_interval,
+                    maxsize=settings.square_webhook_queue_size,
+                    max_attempts=settings.square_webhook_max_attempts,
+                )
+    return _webhooks